@@ -1,3 +1,4 @@
+from django import forms
 from django.contrib import admin
 
 # from openinghours.admin import OpeningHoursInline, ClosingRulesInline
@@ -6,6 +7,8 @@ from .models import *
 
 from openinghours.models import OpeningHours, ClosingRules, Company
 
+from . import unlocks
+
 
 class OpeningHoursInline(admin.TabularInline):
 	model = OpeningHours
@@ -18,6 +21,16 @@ class ClosingRulesInline(admin.StackedInline):
 
 
 
+class ItemForm(forms.ModelForm):
+
+	def clean_next(self):
+		# completing an item can't lead back around to itself
+		next_items = self.cleaned_data.get('next')
+		if self.instance.pk and next_items and unlocks.creates_cycle(self.instance.pk, [i.pk for i in next_items]):
+			raise forms.ValidationError("These next items lead back to this item.")
+		return next_items
+
+
 class BookmarkInline(admin.TabularInline):
 	model = Bookmark
 	extra = 1
@@ -92,6 +105,7 @@ class PlaceAdmin(admin.ModelAdmin):
 
 @admin.register(Item)
 class ItemAdmin(admin.ModelAdmin):
+	form = ItemForm
 	list_display = ('name', 'content', 'sponsor', 'public')
 	def get_queryset(self, request):
 		qs = super(ItemAdmin, self).get_queryset(request)
@@ -121,6 +135,7 @@ class CtaAdmin(admin.ModelAdmin):
 
 @admin.register(Group)
 class GroupAdmin(admin.ModelAdmin):
+	form = ItemForm
 	list_display = ('name', 'items_list')
 	
 	def items_list(self, obj):
@@ -1,18 +1,20 @@
 import json
+import math
 import datetime
 
-from itertools import chain
-from operator import attrgetter
-
 from django.contrib.auth.models import User
 from django.contrib.gis.geos import Point, GEOSGeometry
+from django.contrib.gis.db.models import GeometryField
 from django.contrib.auth.password_validation import validate_password
 from django.http import HttpResponse, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.core.serializers import serialize
-from django.db import models as db_models
+from django.db import models as db_models, transaction
 from django.core.exceptions import ValidationError
-from django.db.models import Q, F, Count
+from django.db.models import Q, F, Max
+from django.utils import timezone
+from django.utils.functional import cached_property
+from django.core.cache import cache
 
 from rest_framework import serializers, viewsets, generics, authentication, permissions
 from rest_framework.decorators import api_view, permission_classes, authentication_classes #, action
@@ -20,17 +22,42 @@ from rest_framework_jwt.authentication import JSONWebTokenAuthentication
 from rest_framework.views import APIView
 from rest_framework.response import Response
 
-from openinghours.models import WEEKDAYS, OpeningHours
-from openinghours import utils
-
 from django_filters.rest_framework import DjangoFilterBackend
 from django_filters import Filter, FilterSet
 from drf_extra_fields.geo_fields import PointField
 
+from . import batch
+from . import cards
+from . import caching
+from . import clusters
+from . import distances
+from . import fieldsets
+from . import locations
+from . import metrics
 from . import models
+from . import pagination
+from . import popularity
+from . import postings
+from . import search
+from . import snapshots
+from . import unlocks
+from . import viewer
+
+
+class ViewerStateMixin(object):
+	# gives serializers the requesting profile's todos / bookmarks / ratings, loaded once per request
+	@property
+	def viewer(self):
+		return viewer.for_request(self.context.get("request"))
+
 
+# denormalized bookkeeping columns that never go out over the API
+ITEM_INTERNAL_FIELDS = ('is_place', 'is_group', 'updated', 'search_vector')
+PLACE_INTERNAL_FIELDS = ITEM_INTERNAL_FIELDS + ('rating_count', 'rating_sum', 'rating_avg', 'geocode_pending', 'hours_index', 'hours_display', 'closing_index')
+GROUP_INTERNAL_FIELDS = ITEM_INTERNAL_FIELDS + ('item_count',)
 
-class UserSerializer(serializers.HyperlinkedModelSerializer):
+
+class UserSerializer(fieldsets.SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
 	class Meta:
 		model = User
 		fields = ('email', 'is_staff', 'id')
@@ -41,24 +68,25 @@ class UserViewSet(viewsets.ReadOnlyModelViewSet):
 	serializer_class = UserSerializer
 
 
-class TipSerializer(serializers.ModelSerializer):
+class TipSerializer(fieldsets.SparseFieldsMixin, serializers.ModelSerializer):
 	class Meta:
 		model = models.Tip
 		fields = ("name", "content")
 
 
-class CtaSerializer(serializers.ModelSerializer):
+class CtaSerializer(fieldsets.SparseFieldsMixin, serializers.ModelSerializer):
 	class Meta:
 		model = models.Cta
 		exclude = ('id',)
 
 
-class BookmarkSerializer(serializers.ModelSerializer):
+class BookmarkSerializer(fieldsets.SparseFieldsMixin, metrics.InstrumentedMixin, ViewerStateMixin, serializers.ModelSerializer):
 	image = serializers.SerializerMethodField()
 	place = serializers.SerializerMethodField()
 	group = serializers.SerializerMethodField()
 	rating = serializers.SerializerMethodField()
 	distance = serializers.SerializerMethodField()
+	distance_km = serializers.SerializerMethodField()
 	items = serializers.SerializerMethodField()
 	article = serializers.SerializerMethodField()
 	bookmarked = serializers.SerializerMethodField()
@@ -66,14 +94,7 @@ class BookmarkSerializer(serializers.ModelSerializer):
 
 	def get_done(self, instance):
 		# return true if this item is marked as done by the user, None if it does not exist
-		request = self.context.get("request")
-		if request:
-			try:
-				profile = request.user.profile
-				return models.Todo.objects.filter(item=instance, profile=profile).first().done
-			except:
-				return None
-		return None
+		return self.viewer.done(instance.id)
 
 	def get_bookmarked(self, instance):
 		# these are bookmarks, they're all bookmarked
@@ -88,50 +109,49 @@ class BookmarkSerializer(serializers.ModelSerializer):
 		return instance.image.url if instance.image else None
 
 	def get_place(self, instance):
-		try:
-			place = getattr(instance, "place")
-			return True
-		except:
-			return False
+		return instance.is_place
 
 	def get_group(self, instance):
-		try:
-			place = getattr(instance, "group")
-			return True
-		except:
-			return False
+		return instance.is_group
 
 	def get_rating(self, instance):
+		if not instance.is_place:
+			return None
 		try:
-			place = getattr(instance, "place")
-			return place.rating()["rating__avg"]
+			return instance.place.rating()["rating__avg"]
 		except:
 			return None
 
 	def get_distance(self, instance):
-		request = self.context.get("request")
-		try:
-			place = getattr(instance, "place")
-			placeloc = place.location
-			profileloc = request.user.profile.location
-			distance = placeloc.distance(profileloc)
-		except:
+		return distances.miles(self.km(instance))
+
+	def get_distance_km(self, instance):
+		return distances.tenths(self.km(instance))
+
+	def km(self, instance):
+		# great circle distance from the user, the list endpoints do this for a whole page at once in cards.py
+		if not instance.is_place or instance.place.location is None or self.viewer.location is None:
 			return None
-		return int( distance * 100 * 6.21371 ) / 10
+		location = instance.place.location
+		return float(distances.haversine_km(self.viewer.location, [(location.x, location.y)])[0])
 
 	def get_items(self, instance):
-		try:
-			count = instance.group.items.count()
-			return count
-		except:
-			return 0
+		# the member count is kept on Group, see Group.count_items
+		return instance.group.item_count if instance.is_group else 0
 
 	class Meta:
 		model = models.Place
-		exclude = ('next', 'phone', 'metro', 'category', 'tags', 'ratings', 'address', 'city', 'state', 'ctas', 'content', 'public', 'link', 'location', 'notes')
+		exclude = ('next', 'phone', 'metro', 'category', 'tags', 'ratings', 'address', 'city', 'state', 'ctas', 'content', 'public', 'link', 'location', 'notes') + PLACE_INTERNAL_FIELDS
+
+
+class SearchResultSerializer(BookmarkSerializer):
+	# search results are the same cards as bookmarks, they just aren't all bookmarked
+
+	def get_bookmarked(self, instance):
+		return self.viewer.bookmarked(instance.id)
 
 
-class ItemSerializer(serializers.ModelSerializer):
+class ItemSerializer(fieldsets.SparseFieldsMixin, metrics.InstrumentedMixin, ViewerStateMixin, serializers.ModelSerializer):
 	image = serializers.SerializerMethodField()
 	article = serializers.SerializerMethodField()
 	group = serializers.SerializerMethodField()
@@ -141,39 +161,18 @@ class ItemSerializer(serializers.ModelSerializer):
 
 	def get_done(self, instance):
 		# return true if this item is marked as done by the user, None if it does not exist
-		request = self.context.get("request")
-		if request:
-			try:
-				profile = request.user.profile
-				return models.Todo.objects.filter(item=instance, profile=profile).first().done
-			except:
-				return None
-		return None
+		return self.viewer.done(instance.id)
 
 	def get_bookmarked(self, instance):
 		# return true if this item is bookmarked by the user
-		request = self.context.get("request")
-		if request:
-			try:
-				profile = request.user.profile
-				return models.Bookmark.objects.filter(item=instance, profile=profile).exists()
-			except:
-				return False
-		return False
+		return self.viewer.bookmarked(instance.id)
 
 	def get_group(self, instance):
-		try:
-			place = getattr(instance, "group")
-			return True
-		except:
-			return False
+		return instance.is_group
 
 	def get_items(self, instance):
-		try:
-			count = instance.group.items.count()
-			return count
-		except:
-			return 0
+		# the member count is kept on Group, see Group.count_items
+		return instance.group.item_count if instance.is_group else 0
 
 	def get_article(self, instance):
 		# return true if it's an article with content
@@ -185,16 +184,16 @@ class ItemSerializer(serializers.ModelSerializer):
 
 	class Meta:
 		model = models.Item
-		exclude = ('next', 'content', 'link', 'ctas', 'notes')
+		exclude = ('next', 'content', 'link', 'ctas', 'notes') + ITEM_INTERNAL_FIELDS
 
 
-class TagSerializer(serializers.ModelSerializer):
+class TagSerializer(fieldsets.SparseFieldsMixin, serializers.ModelSerializer):
 	class Meta:
 		model = models.Tag
 		fields = ('name', 'id')
 
 
-class DiscoverSerializer(serializers.ModelSerializer):
+class DiscoverSerializer(fieldsets.SparseFieldsMixin, metrics.InstrumentedMixin, ViewerStateMixin, serializers.ModelSerializer):
 	id = serializers.ReadOnlyField(source='item.id')
 	name = serializers.ReadOnlyField(source='item.name')
 	sponsor = serializers.ReadOnlyField(source='item.sponsor')
@@ -210,39 +209,17 @@ class DiscoverSerializer(serializers.ModelSerializer):
 
 	def get_todo(self, instance):
 		# return true if this item is in the user's todo list
-		request = self.context.get("request")
-		if request:
-			try:
-				profile = request.user.profile
-				return models.Todo.objects.filter(item=instance.item, profile=profile).exists()
-			except:
-				return False
-		return False
+		return self.viewer.todo(instance.item_id)
 
 	def get_done(self, instance):
 		# return true if this item is marked as done by the user, None if it does not exist
-		request = self.context.get("request")
-		if request:
-			try:
-				profile = request.user.profile
-				return models.Todo.objects.filter(item=instance.item, profile=profile).first().done
-			except:
-				return None
-		return None
+		return self.viewer.done(instance.item_id)
 
 	def get_group(self, instance):
-		try:
-			place = getattr(instance.item, "group")
-			return True
-		except:
-			return False
+		return instance.item.is_group
 
 	def get_items(self, instance):
-		try:
-			count = instance.item.group.items.count()
-			return count
-		except:
-			return 0
+		return instance.item.group.item_count if instance.item.is_group else 0
 
 	def get_article(self, instance):
 		# return true if it's an article with content
@@ -254,14 +231,7 @@ class DiscoverSerializer(serializers.ModelSerializer):
 
 	def get_bookmarked(self, instance):
 		# return true if this item is bookmarked by the user
-		request = self.context.get("request")
-		if request:
-			try:
-				profile = request.user.profile
-				return models.Bookmark.objects.filter(item=instance.item, profile=profile).exists()
-			except:
-				return False
-		return False
+		return self.viewer.bookmarked(instance.item_id)
 
 	class Meta:
 		model = models.Discover
@@ -277,29 +247,15 @@ class TodoSerializer(DiscoverSerializer):
 
 	def get_done(self, instance):
 		# return true if this item is marked as done by the user, None if it does not exist
-		request = self.context.get("request")
-		if request:
-			try:
-				profile = request.user.profile
-				return models.Todo.objects.filter(item=instance.item, profile=profile).first().done
-			except:
-				return None
-		return None
+		return self.viewer.done(instance.item_id)
 
 	def get_bookmarked(self, instance):
 		# return true if this item is bookmarked by the user
-		request = self.context.get("request")
-		if request:
-			try:
-				profile = request.user.profile
-				return models.Bookmark.objects.filter(item=instance.item, profile=profile).exists()
-			except:
-				return False
-		return False
+		return self.viewer.bookmarked(instance.item_id)
 
 	class Meta:
 		model = models.Todo
-		exclude = ('profile', 'item')
+		exclude = ('profile', 'item', 'added')
 
 
 class PopSerializer(BookmarkSerializer):
@@ -308,9 +264,17 @@ class PopSerializer(BookmarkSerializer):
 	def get_score(self, instance):
 		return instance.score
 
+
+# The list endpoints render their cards with these instead of the serializers, see cards.py.
+# Their output is exactly what the serializers would make; the serializers still define the shape.
+TODO_CARDS = cards.Card(TodoSerializer, model=models.Todo, prefix='item__')
+DISCOVER_CARDS = cards.Card(DiscoverSerializer, model=models.Discover, prefix='item__')
+BOOKMARK_CARDS = cards.Card(BookmarkSerializer, methods=cards.ALWAYS_BOOKMARKED)
+POPULAR_CARDS = cards.Card(PopSerializer, methods=cards.ALWAYS_BOOKMARKED)
+ITEM_CARDS = cards.Card(ItemSerializer)
 	
 	
-class FullItemSerializer(serializers.ModelSerializer):
+class FullItemSerializer(fieldsets.SparseFieldsMixin, metrics.InstrumentedMixin, ViewerStateMixin, serializers.ModelSerializer):
 	ctas = CtaSerializer(many=True)
 	image = serializers.SerializerMethodField()
 	video = serializers.SerializerMethodField()
@@ -322,51 +286,22 @@ class FullItemSerializer(serializers.ModelSerializer):
 	place = serializers.SerializerMethodField()
 
 	def get_group(self, instance):
-		try:
-			place = getattr(instance, "group")
-			return True
-		except:
-			return False
+		return instance.is_group
 
 	def get_place(self, instance):
-		try:
-			place = getattr(instance, "place")
-			return True
-		except:
-			return False
+		return instance.is_place
 
 	def get_todo(self, instance):
 		# return true if this item is in the user's todo list
-		request = self.context.get("request")
-		if request:
-			try:
-				profile = request.user.profile
-				return models.Todo.objects.filter(item=instance, profile=profile).exists()
-			except:
-				return False
-		return False
+		return self.viewer.todo(instance.id)
 
 	def get_done(self, instance):
 		# return true if this item is marked as done by the user, None if it does not exist
-		request = self.context.get("request")
-		if request:
-			try:
-				profile = request.user.profile
-				return models.Todo.objects.filter(item=instance, profile=profile).first().done
-			except:
-				return None
-		return None
+		return self.viewer.done(instance.id)
 
 	def get_bookmarked(self, instance):
 		# return true if this item is bookmarked by the user
-		request = self.context.get("request")
-		if request:
-			try:
-				profile = request.user.profile
-				return models.Bookmark.objects.filter(item=instance, profile=profile).exists()
-			except:
-				return False
-		return False
+		return self.viewer.bookmarked(instance.id)
 	
 	def get_article(self, instance):
 		# return true if it's an article with content
@@ -382,21 +317,23 @@ class FullItemSerializer(serializers.ModelSerializer):
 
 	class Meta:
 		model = models.Item
-		exclude = ('next','notes')
+		exclude = ('next','notes') + ITEM_INTERNAL_FIELDS
 
 
-class ItemViewSet(viewsets.ReadOnlyModelViewSet):
+class ItemViewSet(caching.ETagMixin, viewsets.ReadOnlyModelViewSet):
 	queryset = models.Item.objects.all()
+	pagination_class = pagination.KeysetPagination
+	etag_viewer = True
 	serializer_class = FullItemSerializer
 
 
-class MetroSerializer(serializers.ModelSerializer):
+class MetroSerializer(fieldsets.SparseFieldsMixin, serializers.ModelSerializer):
 	class Meta:
 		model = models.Metro
 		fields = ('name', 'id')
 
 
-class CategorySerializer(serializers.ModelSerializer):
+class CategorySerializer(fieldsets.SparseFieldsMixin, metrics.InstrumentedMixin, serializers.ModelSerializer):
 	id = serializers.ReadOnlyField(source='category.id')
 	name = serializers.ReadOnlyField(source='category.name')
 	image = serializers.SerializerMethodField()
@@ -412,86 +349,132 @@ class CategorySerializer(serializers.ModelSerializer):
 		fields = ('id', 'name', 'image', 'tags', 'order')
 
 
-class OrganizationSerializer(serializers.ModelSerializer):
-	# tips = TipSerializer(many=True)
+class OrganizationSerializer(fieldsets.SparseFieldsMixin, metrics.InstrumentedMixin, ViewerStateMixin, serializers.ModelSerializer):
 	discover_items = serializers.SerializerMethodField()
 	popular = serializers.SerializerMethodField()
 	metro = MetroSerializer()
 	categories = serializers.SerializerMethodField()
+	tips = serializers.SerializerMethodField()
 	nav_image = serializers.SerializerMethodField()
 
-	def get_discover_items(self, instance):
-		qset = models.Discover.objects.filter(organization=instance)
+	# the card flags that depend on who's looking, per card list
+	VIEWER_FLAGS = {'discover_items': ('bookmarked', 'done', 'todo'), 'popular': ('done',)}
+	# set while the viewer-free payload is being built, see to_representation
+	_card_ids = None
+	_neutral = None
+
+	def to_representation(self, instance):
+		# A list of profiles shares a few organizations, so each organization's payload is only built once per request,
+		# with the viewer flags left blank, and the flags are laid over a copy of it for every profile.
 		request = self._context.get("request")
-		return [DiscoverSerializer(m, context={'request': request}).data for m in qset]
+		memo = getattr(request, '_organization_payloads', None)
+		if memo is None:
+			memo = {}
+			if request is not None:
+				request._organization_payloads = memo
+		key = (instance.pk, repr(self.selection))
+		if key not in memo:
+			self._card_ids, self._neutral = {}, viewer.ViewerState()
+			try:
+				memo[key] = (super(OrganizationSerializer, self).to_representation(instance), self._card_ids)
+			finally:
+				self._card_ids, self._neutral = None, None
+		payload, card_ids = memo[key]
+		return self.overlay(payload, card_ids)
+
+	def overlay(self, payload, card_ids):
+		state = self.viewer
+		data = payload.copy()
+		for name, flags in self.VIEWER_FLAGS.items():
+			if name not in data:
+				continue
+			cards = []
+			for card, item_id in zip(data[name], card_ids[name]):
+				card = dict(card)
+				for flag in flags:
+					if flag in card:
+						card[flag] = getattr(state, flag)(item_id)
+				cards.append(card)
+			data[name] = cards
+		return data
+
+	def snapshot(self, instance, name):
+		# the prebuilt part of the payload, or None if this request asked for a different shape of it
+		if self.child_selection(name) != fieldsets.EVERYTHING:
+			return None
+		return snapshots.get(instance)
+
+	def get_discover_items(self, instance):
+		snapshot = self.snapshot(instance, 'discover_items') if self._card_ids is not None else None
+		if snapshot is not None:
+			# with blank flags, to_representation lays the viewer's over them
+			self._card_ids['discover_items'] = snapshot['discover_ids']
+			return snapshot['discover_items']
+		selection = self.child_selection('discover_items')
+		rows = DISCOVER_CARDS.rows(models.Discover.objects.filter(organization=instance), selection)
+		if self._card_ids is not None:
+			self._card_ids['discover_items'] = [row[DISCOVER_CARDS.id_column] for row in rows]
+		return DISCOVER_CARDS.render(rows, self._context.get("request"), selection, self._neutral)
 
 	def get_categories(self, instance):
+		snapshot = self.snapshot(instance, 'categories')
+		if snapshot is not None:
+			return snapshot['categories']
 		qset = models.OrgCategory.objects.filter(organization=instance)
-		return [CategorySerializer(m).data for m in qset]
+		return [CategorySerializer(m, context=self.child_context('categories')).data for m in qset]
+
+	def get_tips(self, instance):
+		snapshot = self.snapshot(instance, 'tips')
+		if snapshot is not None:
+			return snapshot['tips']
+		return TipSerializer(instance.tips.all(), many=True, context=self.child_context('tips')).data
 
 	def get_nav_image(self, instance):
 		# returning image url if there is an image else blank string
 		return instance.nav_image.url if instance.nav_image else None
 
 	def get_popular(self, instance):
-		# to determine popularity, we want a list of items that have been todo'd (added to a user's list) and bookmarked the most
-		# we could go through the database and iterate over each item with a for loop and do the math that way, but that's way too slow - too big of a db call and too much math being handled by python
-		# the goal is to put most of the work onto 1-2 database calls, so that SQL can do the heavy lifting - the filtering and adding up foreign keys
-		# a future version of this can be a bit more intensive, weighting date for each item, but would need to be cached so we're not hitting the db and doing all that math with every API call
-		
-		# Get all of the Todo's by users also in this organization, where the items are public
-		org_todos = models.Todo.objects.filter(profile__organization=instance.id, item__public=True).exclude(done=None)
-		# Todo is a through model that connects user profiles with item, and this will return a list of them
-		
-		# Count how many times each Item has been Todo'd and Bookmarked, add those numbers together, then sort by that number and take the top 20
-		items = models.Item.objects.filter(todo_item__in=org_todos).annotate(num_todos=Count('todo_item', distinct=True)).annotate(num_bookmarks=Count('bookmark_item', distinct=True)).annotate(score=F('num_todos') + F('num_bookmarks')).order_by('-score')[:20]
-		# Here we take the Item model, and filter it against that list of Todos, so we have a List of just Items.
-		# Then we add up those Items' connections to Todo and Bookmark models and add them together - annotate reveals these numbers in the user model
-		# Django will take both these lines and create a complex SQL statement to send to the database, something like:
-		# ('SELECT "newto_django_item"."id", "newto_django_item"."name", "newto_django_item"."content", "newto_django_item"."public", "newto_django_item"."sponsor", "newto_django_item"."link", "newto_django_item"."image", COUNT(DISTINCT "newto_django_todo"."id") AS "num_todos", COUNT(DISTINCT "newto_django_bookmark"."id") AS "num_bookmarks", (COUNT(DISTINCT "newto_django_todo"."id") + COUNT(DISTINCT "newto_django_bookmark"."id")) AS "score" FROM "newto_django_item" INNER JOIN "newto_django_todo" ON ("newto_django_item"."id" = "newto_django_todo"."item_id") LEFT OUTER JOIN "newto_django_bookmark" ON ("newto_django_item"."id" = "newto_django_bookmark"."item_id") WHERE "newto_django_todo"."id" IN (SELECT U0."id" FROM "newto_django_todo" U0 INNER JOIN "newto_django_item" U1 ON (U0."item_id" = U1."id") INNER JOIN "newto_django_profile" U2 ON (U0."profile_id" = U2."id") WHERE (U1."public" = True AND U2."organization_id" = 4 AND NOT (U0."done" IS NULL))) GROUP BY "newto_django_item"."id" ORDER BY "score" DESC LIMIT 20')
-		# Which will return a list of Items and their fields
-		
-		# Get all of the public places within the same metro as this Organization
-		org_places = models.Place.objects.filter(metro=instance.metro, public=True)
-		
-		# Count how many times each Place has been Bookmarked, times it by two so it worts well with the others, then sort by that number and take the top 10
-		places = models.Item.objects.filter(place__in=org_places).annotate(num_bookmarks=Count('bookmark_item', distinct=True)).annotate(score=F('num_bookmarks')*2).order_by('-score')[:10]
-		# This is another SQL call that looks like:
-		# ('SELECT "newto_django_item"."id", "newto_django_item"."name", "newto_django_item"."content", "newto_django_item"."public", "newto_django_item"."sponsor", "newto_django_item"."link", "newto_django_item"."image", COUNT(DISTINCT "newto_django_bookmark"."id") AS "num_bookmarks", (COUNT(DISTINCT "newto_django_bookmark"."id") * 2) AS "score" FROM "newto_django_item" INNER JOIN "newto_django_place" ON ("newto_django_item"."id" = "newto_django_place"."item_ptr_id") LEFT OUTER JOIN "newto_django_bookmark" ON ("newto_django_item"."id" = "newto_django_bookmark"."item_id") WHERE "newto_django_place"."item_ptr_id" IN (SELECT U0."item_ptr_id" FROM "newto_django_place" U0 INNER JOIN "newto_django_place_metro" U1 ON (U0."item_ptr_id" = U1."place_id") INNER JOIN "newto_django_item" U3 ON (U0."item_ptr_id" = U3."id") WHERE (U1."metro_id" = 3 AND U3."public" = True)) GROUP BY "newto_django_item"."id" ORDER BY "score" DESC LIMIT 10')
-		# Which will return a list of Items and their fields. Place is the child class of Item, so it makes sense to have a bunch of Items to combine, then sort out which ones are Places, Groups, etc in the API Serializer
-
-		# Now that we've got two lists of items, we can combine them, and sort them all (20 items, 10 places) by their score.
-		qset = sorted( chain(items, places), key=attrgetter('score'), reverse=True)
-
-		# Once we have one big list of items and their data, we send it to the API Serializer to be turned into JSON and sent back to the user
-		return [PopSerializer(m, context={'request': self._context.get("request")}).data for m in qset]
+		# to determine popularity, we want a list of items that have been todo'd (added to a user's list) and bookmarked the most, weighted by date
+		# recounting Todos and Bookmarks with every API call was too much work for the db, so the add/remove endpoints keep a leaderboard
+		# per organization (items) and per metro (places) up to date as they go, with older activity decaying away - see popularity.py
+		# here we just read the top 20 items and top 10 places, already sorted by score
+		scores = popularity.top(instance)
+
+		# Once we have one big list of items and their scores, we turn them into cards to be sent back to the user
+		selection = self.child_selection('popular')
+		rows = dict((row['id'], row) for row in POPULAR_CARDS.rows(models.Item.objects.filter(pk__in=[item_id for item_id, score in scores]), selection))
+		rows = [dict(rows[item_id], score=score) for item_id, score in scores if item_id in rows]
+		if self._card_ids is not None:
+			self._card_ids['popular'] = [row['id'] for row in rows]
+		return POPULAR_CARDS.render(rows, self._context.get("request"), selection, self._neutral)
 
 	class Meta:
 		model = models.Organization
-		fields = ('name', 'metro', 'id', 'discover_items', 'popular', 'nav_name', 'nav_image', 'categories', 'link')
+		fields = ('name', 'metro', 'id', 'discover_items', 'popular', 'nav_name', 'nav_image', 'categories', 'tips', 'link')
 
 
-class SimpleOrganizationSerializer(serializers.ModelSerializer):
+class SimpleOrganizationSerializer(fieldsets.SparseFieldsMixin, serializers.ModelSerializer):
 	class Meta:
 		model = models.Organization
 		fields = ('name', 'id')
 
 
-class OrganizationViewSet(viewsets.ReadOnlyModelViewSet):
+class OrganizationViewSet(caching.ETagMixin, viewsets.ReadOnlyModelViewSet):
 	queryset = models.Organization.objects.filter(public=True)
 	serializer_class = SimpleOrganizationSerializer
 
 
-class ProfileSerializer(serializers.ModelSerializer):
+class ProfileSerializer(fieldsets.SparseFieldsMixin, metrics.InstrumentedMixin, serializers.ModelSerializer):
 	user = UserSerializer()
 	organization = OrganizationSerializer()
-	bookmarks = BookmarkSerializer(many=True)
+	bookmarks = serializers.SerializerMethodField()
 	todo = serializers.SerializerMethodField()
 
+	def get_bookmarks(self, instance):
+		return BOOKMARK_CARDS.list(instance.bookmarks.all(), self._context.get("request"), self.child_selection('bookmarks'))
+
 	def get_todo(self, instance):
-		qset = models.Todo.objects.filter(profile=instance, done=False)
-		request = self._context.get("request")
-		return [TodoSerializer(m, context={'request': request}).data for m in qset]
+		return TODO_CARDS.list(models.Todo.objects.filter(profile=instance, done=False), self._context.get("request"), self.child_selection('todo'))
 
 	class Meta:
 		model = models.Profile
@@ -499,62 +482,43 @@ class ProfileSerializer(serializers.ModelSerializer):
 
 
 class ProfileViewSet(viewsets.ReadOnlyModelViewSet):
-	queryset = models.Profile.objects.all()
+	queryset = models.Profile.objects.select_related('user', 'organization__metro', 'organization__snapshot')
+	pagination_class = pagination.KeysetPagination
 	serializer_class = ProfileSerializer
 
 
-class PlaceSerializer(serializers.ModelSerializer):
+METERS_PER_MILE = 1609.344
+
+
+class PlaceSerializer(fieldsets.SparseFieldsMixin, metrics.InstrumentedMixin, ViewerStateMixin, serializers.ModelSerializer):
 	image = serializers.SerializerMethodField()
 	rating = serializers.SerializerMethodField()
 	distance = serializers.SerializerMethodField()
+	distance_km = serializers.SerializerMethodField()
 	location = PointField(required=False)
 	bookmarked = serializers.SerializerMethodField()
 	yourrating = serializers.SerializerMethodField()
 	openhours = serializers.SerializerMethodField()
 
 	def get_openhours(self, instance):
+		# answered from the place's compiled hours index, see Place.compile_hours
 		now = datetime.datetime.now()
-		try: 
-			open = utils.is_open(instance, now=now)
-			if open:
-				openstring = "Open Now"
-			else:
-				openstring = "Closed Now"
-		except:
+		if instance.is_open(now):
+			openstring = "Open Now"
+		else:
 			openstring = "Closed Now"
-		ohrs = OpeningHours.objects.filter(company=instance, weekday=now.isoweekday()).order_by('weekday','from_hour')
-		if len(ohrs) > 0:
-			openstring += " : "
-		for o in ohrs:
-			openstring += '%s%s to %s%s ' % (
-				o.from_hour.strftime('%I:%M').lstrip('0'),
-				o.from_hour.strftime('%p').lower(),
-				o.to_hour.strftime('%I:%M').lstrip('0'),
-				o.to_hour.strftime('%p').lower()
-			)
+		today = instance.hours_today(now)
+		if today:
+			openstring += " : " + today
 		return openstring
 
 	def get_yourrating(self, instance):
-		# return true if this item is bookmarked by the user
-		request = self.context.get("request")
-		if request:
-			try:
-				profile = request.user.profile
-				return models.Rating.objects.get(place=instance, profile=profile).rating
-			except:
-				return None
-		return None
+		# return the user's own rating of this place, None if they haven't rated it
+		return self.viewer.rating(instance.id)
 
 	def get_bookmarked(self, instance):
 		# return true if this item is bookmarked by the user
-		request = self.context.get("request")
-		if request:
-			try:
-				profile = request.user.profile
-				return models.Bookmark.objects.filter(item=instance, profile=profile).exists()
-			except:
-				return False
-		return False
+		return self.viewer.bookmarked(instance.id)
 
 	def get_image(self, instance):
 		# returning image url if there is an image else null
@@ -567,57 +531,165 @@ class PlaceSerializer(serializers.ModelSerializer):
 			return None
 
 	def get_distance(self, instance):
-		request = self.context.get("request")
-		try:
-			place = getattr(instance, "place")
-			placeloc = place.location
-			profileloc = request.user.profile.location
-			distance = placeloc.distance(profileloc)
-		except:
+		# the distance is annotated by the database in PlaceFilter, in metres, return it in miles
+		distance = getattr(instance, "distance", None)
+		if distance is None:
 			return None
-		return int( distance * 100 * 6.21371 ) / 10
+		return int( distance / METERS_PER_MILE * 10 ) / 10
+
+	def get_distance_km(self, instance):
+		distance = getattr(instance, "distance", None)
+		if distance is None:
+			return None
+		return distances.tenths(distance / 1000)
 
 	class Meta:
 		model = models.Place
-		exclude = ('next', 'ctas', 'ratings', 'metro', 'category', 'tags')
+		exclude = ('next', 'ctas', 'ratings', 'metro', 'category', 'tags') + PLACE_INTERNAL_FIELDS
+
+
+class SphereDistance(db_models.Func):
+	# great circle distance in metres between two points
+	# our points are stored as Point(latitude, longitude), so both get flipped to PostGIS's (longitude, latitude) first
+	function = 'ST_DistanceSphere'
+	template = '%(function)s(ST_FlipCoordinates(%(expressions)s))'
+	arg_joiner = '), ST_FlipCoordinates('
+	output_field = db_models.FloatField()
 
 
 class M2MFilter(Filter):
 	
+	# comma separated tag ids, places have to have all of them
 	def filter(self, qs, value):
+		return postings.restrict(qs, tags=self.tag_ids(value))
+
+	def tag_ids(self, value):
 		if not value:
-			return qs
-	
-		values = value.split(',')
-		for v in values:
-			qs = qs.filter(tags=v)
-		return qs
+			return []
+		try:
+			return [int(v) for v in value.split(',')]
+		except ValueError:
+			return []
 
 
 class DistanceFilter(Filter):
 	
-	# this needs to do distance calculations later, or connect to the serializer's function
+	# ?maxdistance= in miles, from the ?near= point or the user's location
+	def filter(self, qs, value):
+		origin = self.parent.origin
+		if not value or origin is None:
+			return qs
+		try:
+			miles = float(value)
+		except ValueError:
+			return qs
+		# ST_DWithin runs against the GiST index but works in planar degrees, so pad the radius for degrees of longitude shrinking away from the equator,
+		# then trim to the exact great circle distance, which only gets computed for the places the index let through
+		degrees = miles / (69.0 * max(math.cos(math.radians(origin.x)), 0.01))
+		return qs.filter(location__dwithin=(origin, degrees), distance__lte=miles * METERS_PER_MILE)
+
+
+class NearFilter(Filter):
+
+	# ?near=lat,lng sorts places nearest first
 	def filter(self, qs, value):
-		return qs
+		origin = self.parent.origin
+		if not value or origin is None:
+			return qs
+		# by the great circle distance PlaceFilter annotates, the same one the serializer returns; planar degrees would put
+		# a place east of the origin behind a farther one north of it. ?maxdistance= narrows the candidates on the index first.
+		return qs.filter(location__isnull=False).order_by('distance', 'id')
+
+
+class OpenNowFilter(Filter):
+
+	# ?open_now=1 only returns places that are open right now, the same test as Place.hours_open but done by the database:
+	# no closing rule pair covers now, and an odd number of the place's hours_index boundaries are at or before this minute of the week
+	SQL = (
+		'NOT EXISTS (SELECT 1 FROM generate_subscripts({table}.closing_index, 1) AS i '
+		'WHERE i %% 2 = 1 AND {table}.closing_index[i] <= %s AND %s <= {table}.closing_index[i + 1]) '
+		'AND (SELECT count(*) FROM unnest({table}.hours_index) AS b WHERE b <= %s) %% 2 = 1'
+	)
+
+	def filter(self, qs, value):
+		if value not in ('1', 'true', 'True'):
+			return qs
+		now = datetime.datetime.now()
+		minute = (now.isoweekday() - 1) * models.MINUTES_PER_DAY + now.hour * 60 + now.minute
+		instant = timezone.now()
+		return qs.extra(where=[self.SQL.format(table='"%s"' % models.Place._meta.db_table)], params=[instant, instant, minute])
 
 
 class PlaceFilter(FilterSet):
 	tags = M2MFilter()
 	maxdistance = DistanceFilter()
+	near = NearFilter()
+	open_now = OpenNowFilter()
 	
 	class Meta:
 		model = models.Place
-		fields = ('category','metro','tags','maxdistance')
+		fields = ('category','metro','tags','maxdistance','near','open_now')
 
+	@cached_property
+	def origin(self):
+		# the point distances are measured from: ?near=lat,lng if it's given, otherwise the user's location
+		near = self.data.get('near')
+		if near:
+			try:
+				latitude, longitude = [float(v) for v in near.split(',')]
+			except ValueError:
+				return None
+			return Point(latitude, longitude, srid=4326)
+		try:
+			return self.request.user.profile.location
+		except:
+			return None
 
-class PlaceViewSet(viewsets.ReadOnlyModelViewSet):
+	def filter_queryset(self, queryset):
+		# annotate the distance in the database, so the filters and the serializer can all use it
+		if self.origin is not None:
+			queryset = queryset.annotate(distance=SphereDistance(F('location'), db_models.Value(self.origin, output_field=GeometryField(srid=4326))))
+		# tags, category and metro are matched against their posting lists, rather than joining the m2m tables
+		data = self.form.cleaned_data
+		queryset = postings.restrict(
+			queryset,
+			tags=self.filters['tags'].tag_ids(data.get('tags')),
+			categories=[c.pk for c in data.get('category') or []],
+			metros=[m.pk for m in data.get('metro') or []],
+		)
+		for name, value in data.items():
+			if name not in ('tags', 'category', 'metro'):
+				queryset = self.filters[name].filter(queryset, value)
+		return queryset
+
+
+class PlaceViewSet(caching.ETagMixin, viewsets.ReadOnlyModelViewSet):
 	queryset = models.Place.objects.all()
+	pagination_class = pagination.KeysetPagination
+	etag_viewer = True
+	etag_clock = True
 	serializer_class = PlaceSerializer
 	filter_backends = (DjangoFilterBackend,)
 	filterset_class = PlaceFilter
 
 
-class GroupSerializer(serializers.ModelSerializer):
+class GroupListSerializer(serializers.ListSerializer):
+	# A page of groups loads its tags and all of its member cards together, in a fixed number of queries,
+	# instead of a tags query and two card queries for every group on it
+
+	def to_representation(self, data):
+		groups = list(data.all() if isinstance(data, db_models.Manager) else data)
+		fields = self.child.fields
+		if 'tags' in fields:
+			db_models.prefetch_related_objects(groups, 'tags')
+		self.child._members = self.child.members(groups) if 'items' in fields else None
+		try:
+			return super(GroupListSerializer, self).to_representation(groups)
+		finally:
+			self.child._members = None
+
+
+class GroupSerializer(fieldsets.SparseFieldsMixin, metrics.InstrumentedMixin, ViewerStateMixin, serializers.ModelSerializer):
 	items = serializers.SerializerMethodField()
 	image = serializers.SerializerMethodField()
 	bookmarked = serializers.SerializerMethodField()
@@ -638,78 +710,73 @@ class GroupSerializer(serializers.ModelSerializer):
 
 	def get_todo(self, instance):
 		# return true if this item is marked as done by the user
-		request = self.context.get("request")
-		if request:
-			try:
-				profile = request.user.profile
-				return models.Todo.objects.filter(item=instance, profile=profile).exists()
-			except:
-				return False
-		return False
+		return self.viewer.todo(instance.id)
 
 	def get_done(self, instance):
 		# return true if this item is marked as done by the user, None if it does not exist
-		request = self.context.get("request")
-		if request:
-			try:
-				profile = request.user.profile
-				return models.Todo.objects.filter(item=instance, profile=profile).first().done
-			except:
-				return None
-		return None
+		return self.viewer.done(instance.id)
 
 	def get_bookmarked(self, instance):
 		# return true if this item is bookmarked by the user
-		request = self.context.get("request")
-		if request:
-			try:
-				profile = request.user.profile
-				return models.Bookmark.objects.filter(item=instance, profile=profile).exists()
-			except:
-				return False
-		return False
+		return self.viewer.bookmarked(instance.id)
 
 	def get_image(self, instance):
 		# returning image url if there is an image else blank string
 		return instance.image.url if instance.image else None
 
+	# {group id: member cards}, set by GroupListSerializer for the page it's rendering
+	_members = None
+
+	def members(self, groups):
+		# the member cards of all of these groups: their memberships, the members' rows and the members' tags, in three queries
+		pairs = list(models.Group.items.through.objects.filter(group_id__in=[g.pk for g in groups]).order_by('pk').values_list('group_id', 'item_id'))
+		selection = self.child_selection('items')
+		rows = ITEM_CARDS.rows(models.Item.objects.filter(pk__in=set(item_id for group_id, item_id in pairs)), selection)
+		cards = dict((row[ITEM_CARDS.id_column], card) for row, card in zip(rows, ITEM_CARDS.render(rows, self._context.get("request"), selection)))
+		members = {}
+		for group_id, item_id in pairs:
+			if item_id in cards:
+				members.setdefault(group_id, []).append(cards[item_id])
+		return members
+
 	def get_items(self, instance):
-		qset = instance.items.all()
-		request = self._context.get("request")
-		return [ItemSerializer(m, context={'request': request}).data for m in qset]
+		if self._members is not None:
+			return self._members.get(instance.pk, [])
+		# a group on its own: member cards, with their group counts and tags, in two queries
+		return ITEM_CARDS.list(instance.items.all(), self._context.get("request"), self.child_selection('items'))
 
 	class Meta:
 		model = models.Group
-		exclude = ('next', 'ctas', 'link')
+		exclude = ('next', 'ctas', 'link') + GROUP_INTERNAL_FIELDS
+		list_serializer_class = GroupListSerializer
 
 
 class GroupViewSet(viewsets.ReadOnlyModelViewSet):
 	queryset = models.Group.objects.all()
+	pagination_class = pagination.KeysetPagination
 	serializer_class = GroupSerializer
 
 
-class MeSerializer(serializers.ModelSerializer):
+class MeSerializer(fieldsets.SparseFieldsMixin, metrics.InstrumentedMixin, serializers.ModelSerializer):
 	# do we need any bits of the user beyond email?
 	# email = serializers.ReadOnlyField(source='user.email')
 	user = UserSerializer()
-	bookmarks = BookmarkSerializer(many=True)
+	bookmarks = serializers.SerializerMethodField()
 	todo = serializers.SerializerMethodField()
 	organization= serializers.SerializerMethodField()
 	complete = serializers.SerializerMethodField()
 
+	def get_bookmarks(self, instance):
+		return BOOKMARK_CARDS.list(instance.bookmarks.all(), self._context.get("request"), self.child_selection('bookmarks'))
+
 	def get_complete(self, instance):
-		qset = models.Todo.objects.filter(profile=instance, done=True)
-		request = self._context.get("request")
-		return [TodoSerializer(m, context={'request': request}).data for m in qset]
+		return TODO_CARDS.list(models.Todo.objects.filter(profile=instance, done=True), self._context.get("request"), self.child_selection('complete'))
 
 	def get_todo(self, instance):
-		qset = models.Todo.objects.filter(profile=instance, done=False)
-		request = self._context.get("request")
-		return [TodoSerializer(m, context={'request': request}).data for m in qset]
+		return TODO_CARDS.list(models.Todo.objects.filter(profile=instance, done=False), self._context.get("request"), self.child_selection('todo'))
 
 	def get_organization(self, instance):
-		request = self._context.get("request")
-		return OrganizationSerializer(instance.organization, context={'request': request}).data
+		return OrganizationSerializer(instance.organization, context=self.child_context('organization')).data
 
 	class Meta:
 		model = models.Profile
@@ -722,9 +789,35 @@ class MeViewSet(viewsets.ReadOnlyModelViewSet):
 	serializer_class = MeSerializer
 	
 	def list(self, *args, **kwargs):
-		queryset = models.Profile.objects.filter(user=self.request.user.pk)
-		serializer = MeSerializer(queryset, many=True, context={'request': self.request })
-		return Response(serializer.data)
+		# the payload is cached per profile under a version that the mutation endpoints bump, so it's only rebuilt when something changed,
+		# and a client that already has this version gets a 304 before the cache is even read
+		try:
+			profile = self.request.user.profile
+			key = caching.me_key(profile.id, self.request, profile.organization_id)
+		except models.Profile.DoesNotExist:
+			key = None
+		etag = None
+		if key:
+			etag = caching.me_etag(key, self.categories_updated(profile.organization_id))
+			if caching.not_modified(self.request, etag):
+				return Response(status=304, headers={'ETag': etag})
+		data = cache.get(key) if key else None
+		if data is None:
+			queryset = models.Profile.objects.filter(user=self.request.user.pk).select_related('user', 'organization__metro', 'organization__snapshot')
+			serializer = MeSerializer(queryset, many=True, context={'request': self.request })
+			data = serializer.data
+			if key:
+				cache.set(key, data, caching.ME_CACHE_TIMEOUT)
+		response = Response(data)
+		if etag:
+			response['ETag'] = etag
+		return response
+
+	def categories_updated(self, organization_id):
+		# when the organization's categories last changed, they're in the payload
+		if organization_id is None:
+			return None
+		return models.OrgCategory.objects.filter(organization=organization_id).aggregate(updated=Max('category__updated'))['updated']
 
 	
 @csrf_exempt
@@ -749,6 +842,20 @@ def passwordCheck(request):
 	return HttpResponse(status=400)
 
 
+def add_default_items(profiles, organization):
+	# give each of these profiles the organization's default todo items, with one read of the Default rows and one bulk insert
+	defaults = []
+	seen = set()
+	for item_id, order in models.Default.objects.filter(organization=organization).values_list('item_id', 'order'):
+		if item_id not in seen:
+			seen.add(item_id)
+			defaults.append((item_id, order if order is not None else 0))
+	models.Todo.objects.bulk_create([
+		models.Todo(profile=profile, item_id=item_id, order=order) for profile in profiles for item_id, order in defaults
+	])
+	popularity.organization_todos_added(organization.id, seen, count=len(profiles))
+
+
 @csrf_exempt
 def onboarding(request):
 	# should this require rest-auth token authentication?
@@ -759,6 +866,7 @@ def onboarding(request):
 	if request.method == 'POST' and email and id:
 		if User.objects.filter(email=email,id=id).exists():
 			profile = models.Profile.objects.get(user=id)
+			popularity.todos_removed(profile, models.Todo.objects.filter(profile=profile).values_list('item_id', 'added'))
 			if organization_id:
 				profile.organization = models.Organization.objects.get(id=organization_id)
 			if hometown:
@@ -767,10 +875,9 @@ def onboarding(request):
 			profile.todo.clear()
 			# add default items from organization
 			if profile.organization:
-				for item in profile.organization.default_items.all():
-					new_todo_item = models.Todo(profile=profile, item=item, order=models.Default.objects.get(organization=profile.organization, item=item).order)
-					new_todo_item.save()
+				add_default_items([profile], profile.organization)
 			profile.save()
+			caching.bump_profile(profile.id)
 			data = {
 				'id': profile.user.id,
 				'hometown': profile.hometown,
@@ -792,10 +899,14 @@ def AddBookmark(request):
 			profile = request.user.profile
 			bookmark = models.Bookmark.objects.filter(profile=profile, item=item)
 			if bookmark:
+				previous = bookmark[0].datetime
 				bookmark.update(datetime=datetime.datetime.now())
+				popularity.bookmark_added(profile, item.id, previous)
 			else:
 				bookmark = models.Bookmark(profile=profile, item=item)
 				bookmark.save()
+				popularity.bookmark_added(profile, item.id)
+			caching.bump_profile(profile.id)
 			return Response( { "success": True, "id": int(request.data["id"]) } )
 		except:
 			return Response( { "success": False, "id": int(request.data["id"]) } )
@@ -809,7 +920,11 @@ def RemoveBookmark(request):
 		try: 
 			item = models.Item.objects.get(id=int(request.data["id"]))
 			profile = request.user.profile
-			models.Bookmark.objects.filter(profile=profile, item=item).delete()
+			bookmark = models.Bookmark.objects.filter(profile=profile, item=item)
+			for when in bookmark.values_list('datetime', flat=True):
+				popularity.bookmark_removed(profile, item.id, when)
+			bookmark.delete()
+			caching.bump_profile(profile.id)
 			return Response( { "success": True, "id": int(request.data["id"]) } )
 		except:
 			return Response( { "success": False, "id": int(request.data["id"]) } )
@@ -829,10 +944,10 @@ def AddDone(request):
 			else:
 				todo = models.Todo(profile=profile, item=item, order=1, done=True)
 				todo.save()
+				popularity.todos_added(profile, [item.id])
 			# add next items to list here
-			for nextitem in todo.first().item.next.all():
-				if not models.Todo.objects.filter(profile=profile, item=nextitem).exists():
-					models.Todo(profile=profile, item=nextitem, order=1, done=False).save()
+			popularity.todos_added(profile, unlocks.unlock(profile, item.id))
+			caching.bump_profile(profile.id)
 			return Response( { "success": True, "id": int(request.data["id"]) } )
 		except:
 			return HttpResponse(status=400)
@@ -847,6 +962,7 @@ def RemoveDone(request):
 			item = models.Item.objects.get(id=int(request.data["id"]))
 			profile = request.user.profile
 			models.Todo.objects.filter(profile=profile, item=item).update(done=False)
+			caching.bump_profile(profile.id)
 			return Response( { "success": True, "id": int(request.data["id"]) } )
 		except:
 			return Response( { "success": False, "id": int(request.data["id"]) } )
@@ -866,6 +982,8 @@ def AddList(request):
 			else:
 				todo = models.Todo(profile=profile, item=item, order=1, done=False)
 				todo.save()
+				popularity.todos_added(profile, [item.id])
+			caching.bump_profile(profile.id)
 			return Response( { "success": True, "id": int(request.data["id"]) } )
 		except:
 			return HttpResponse(status=400)
@@ -879,7 +997,10 @@ def RemoveList(request):
 		try: 
 			item = models.Item.objects.get(id=int(request.data["id"]))
 			profile = request.user.profile
-			models.Todo.objects.filter(profile=profile, item=item).delete()
+			todo = models.Todo.objects.filter(profile=profile, item=item)
+			popularity.todos_removed(profile, todo.values_list('item_id', 'added'))
+			todo.delete()
+			caching.bump_profile(profile.id)
 			return Response( { "success": True, "id": int(request.data["id"]) } )
 		except:
 			return Response( { "success": False, "id": int(request.data["id"]) } )
@@ -893,12 +1014,17 @@ def AddRating(request):
 		try: 
 			place = models.Place.objects.get(id=int(request.data["id"]))
 			profile = request.user.profile
-			rating = models.Rating.objects.filter(profile=profile, place=place)
-			if rating:
-				rating.update(rating=int(request.data["rating"]))
-			else:
-				rating = models.Rating(profile=profile, place=place, rating=int(request.data["rating"]) )
-				rating.save()
+			with transaction.atomic():
+				# lock the user's existing rating rows so the aggregate delta is computed against what we overwrite
+				rating = models.Rating.objects.select_for_update().filter(profile=profile, place=place)
+				previous = [r.rating for r in rating]
+				if previous:
+					rating.update(rating=int(request.data["rating"]))
+					place.add_to_rating(sum(int(request.data["rating"]) - p for p in previous))
+				else:
+					# the post_save receiver adds it to the place's aggregates
+					models.Rating(profile=profile, place=place, rating=int(request.data["rating"]) ).save()
+			caching.bump_profile(profile.id)
 			return Response( { "success": True, "id": int(request.data["id"]), "rating": int(request.data["rating"]) } )
 		except:
 			return HttpResponse(status=400)
@@ -915,6 +1041,7 @@ def AddTodo(request):
 			profile = request.user.profile
 			todo = models.Todo(profile=profile, item=item, order=1, done=False)
 			todo.save()
+			caching.bump_profile(profile.id)
 			return Response( { "success": True, "id": item.id } )
 		except:
 			return Response( { "success": False } )
@@ -927,9 +1054,96 @@ def Location(request):
 	if request.method == 'POST' and request.data["latitude"] and request.data["longitude"]:
 		try: 
 			profile = request.user.profile
-			profile.location = Point(float(request.data["latitude"]), float(request.data["longitude"]))
-			profile.save()
-			return Response( { "success": True } )
+			latitude, longitude = float(request.data["latitude"]), float(request.data["longitude"])
 		except:
 			return HttpResponse(status=400)
+		# buffered and written in bulk, see locations.py
+		locations.record(profile, latitude, longitude)
+		return Response( { "success": True } )
+	return HttpResponse(status=400)
+
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAuthenticated])
+def Batch(request):
+	# runs an ordered list of operations, like [{"op": "addbookmark", "id": 12}, {"op": "addrating", "id": 40, "rating": 5}],
+	# in one transaction, and returns a result for each of them in the same order
+	operations = request.data.get("operations") if isinstance(request.data, dict) else None
+	if request.method == 'POST' and isinstance(operations, list):
+		results = batch.Batch(request.user.profile, operations).run()
+		return Response( { "success": True, "results": results } )
+	return HttpResponse(status=400)
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def Search(request):
+	# ranked prefix search over public items, places in the user's metro and the organization's tips, ?q=coffee+sh
+	q = search.query(request.GET.get("q"))
+	if q is None:
+		return Response( { "items": [], "tips": [] } )
+	try:
+		limit = min(max(int(request.GET.get("limit", 20)), 1), 50)
+	except ValueError:
+		limit = 20
+	organization = request.user.profile.organization
+	selection = fieldsets.from_request(request)
+	data = {}
+	if fieldsets.keep(selection, "items"):
+		context = {'request': request, 'fieldsets': fieldsets.child(selection, "items")}
+		data["items"] = SearchResultSerializer(search.items(organization, q, limit), many=True, context=context).data
+	if fieldsets.keep(selection, "tips"):
+		context = {'request': request, 'fieldsets': fieldsets.child(selection, "tips")}
+		data["tips"] = TipSerializer(search.tips(organization, q, limit), many=True, context=context).data
+	return Response(data)
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def PlaceClusters(request):
+	# map clusters for ?bbox=south,west,north,east&zoom=12, in the user's metro unless ?metro= is given, optionally for one ?category=
+	try:
+		south, west, north, east = [float(v) for v in request.GET["bbox"].split(",")]
+		zoom = int(request.GET.get("zoom", clusters.MIN_ZOOM))
+		metro = int(request.GET["metro"]) if request.GET.get("metro") else request.user.profile.organization.metro_id
+		category = int(request.GET["category"]) if request.GET.get("category") else None
+	except (KeyError, ValueError, AttributeError):
+		return HttpResponse(status=400)
+	zoom, rows = clusters.query(metro, zoom, south, west, north, east, category)
+	return Response( { "zoom": zoom, "clusters": [
+		{ "count": r["count"], "latitude": r["latitude"], "longitude": r["longitude"], "place": { "id": r["place_id"], "name": r["place__name"] } }
+		for r in rows
+	] } )
+
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAdminUser])
+def bulkOnboarding(request):
+	# onboard a whole cohort into an organization at once: staff post the organization and a list of user ids,
+	# every profile's list is reset to the organization's default items with a handful of set-based queries
+	organization_id = request.data.get("organization")
+	ids = request.data.get("ids")
+	if request.method == 'POST' and organization_id and isinstance(ids, list):
+		try:
+			organization = models.Organization.objects.get(id=int(organization_id))
+			ids = [int(i) for i in ids]
+		except (models.Organization.DoesNotExist, TypeError, ValueError):
+			return HttpResponse(status=400)
+		with transaction.atomic():
+			profiles = list(models.Profile.objects.filter(user__in=ids))
+			old_todos = models.Todo.objects.filter(profile__in=profiles)
+			# per leaderboard, so each item leaves each organization's board in one write however many profiles had it
+			removed = {}
+			for organization_id, item_id, added in old_todos.values_list('profile__organization_id', 'item_id', 'added'):
+				removed.setdefault(organization_id, []).append((item_id, added))
+			for organization_id, todos in removed.items():
+				popularity.organization_todos_removed(organization_id, todos)
+			old_todos.delete()
+			models.Profile.objects.filter(pk__in=[p.pk for p in profiles]).update(organization=organization)
+			for profile in profiles:
+				profile.organization = organization
+			add_default_items(profiles, organization)
+		for profile in profiles:
+			caching.bump_profile(profile.id)
+		return Response( { "success": True, "organization": organization.id, "ids": [p.user_id for p in profiles] } )
 	return HttpResponse(status=400)
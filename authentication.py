@@ -0,0 +1,103 @@
+import json
+import hashlib
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import cache
+from django.utils.functional import SimpleLazyObject
+from django.utils.translation import ugettext as _
+
+from rest_framework import exceptions
+from rest_framework_jwt.authentication import JSONWebTokenAuthentication
+from rest_framework_jwt.settings import api_settings
+
+
+# Authenticated users come with their profile, organization and metro from one joined query, since nearly every view reads them.
+# To use it:
+#   REST_FRAMEWORK['DEFAULT_AUTHENTICATION_CLASSES'] = ('newto_django.authentication.ProfileJSONWebTokenAuthentication', ...)
+#   AUTHENTICATION_BACKENDS = ('newto_django.authentication.ProfileModelBackend',)
+#   MIDDLEWARE += ['newto_django.authentication.JWTUserMiddleware'], after AuthenticationMiddleware
+
+RELATED = 'profile__organization__metro'
+
+# seconds a token's user is cached for; 0 turns it off. Keep it short, changes to the profile or organization show up this late
+AUTH_CACHE_TIMEOUT = getattr(settings, 'AUTH_CACHE_TIMEOUT', 0)
+
+jwt_decode_handler = api_settings.JWT_DECODE_HANDLER
+jwt_get_username_from_payload = api_settings.JWT_PAYLOAD_GET_USERNAME_HANDLER
+
+
+def load_user(**kwargs):
+	return get_user_model().objects.select_related(RELATED).get(**kwargs)
+
+
+class ProfileJSONWebTokenAuthentication(JSONWebTokenAuthentication):
+	# JSONWebTokenAuthentication, loading the user with their profile, organization and metro,
+	# reusing what JWTUserMiddleware already resolved for this request, and optionally caching it per token
+
+	def authenticate(self, request):
+		resolved = getattr(request._request, '_jwt_auth', None)
+		if resolved is not None:
+			return resolved
+		result = super(ProfileJSONWebTokenAuthentication, self).authenticate(request)
+		request._request._jwt_auth = result
+		return result
+
+	def authenticate_credentials(self, payload):
+		# the token has been decoded and checked (signature, expiry) by now, so the payload identifies it
+		username = jwt_get_username_from_payload(payload)
+		if not username:
+			raise exceptions.AuthenticationFailed(_('Invalid payload.'))
+		key = None
+		if AUTH_CACHE_TIMEOUT:
+			key = 'auth:%s' % hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+			user = cache.get(key)
+			if user is not None:
+				return user
+		try:
+			user = load_user(**{get_user_model().USERNAME_FIELD: username})
+		except get_user_model().DoesNotExist:
+			raise exceptions.AuthenticationFailed(_('Invalid signature.'))
+		if not user.is_active:
+			raise exceptions.AuthenticationFailed(_('User account is disabled.'))
+		if key:
+			cache.set(key, user, AUTH_CACHE_TIMEOUT)
+		return user
+
+
+class ProfileModelBackend(ModelBackend):
+	# the same for session logins, like the admin and the browsable api
+
+	def get_user(self, user_id):
+		try:
+			user = load_user(pk=user_id)
+		except get_user_model().DoesNotExist:
+			return None
+		return user if self.user_can_authenticate(user) else None
+
+
+class JWTUserMiddleware(object):
+	# Resolves a JWT on plain Django views too (emailCheck, the metrics middleware), lazily, and only once per request:
+	# ProfileJSONWebTokenAuthentication picks up the result instead of decoding the token again.
+
+	def __init__(self, get_response):
+		self.get_response = get_response
+
+	def __call__(self, request):
+		header = request.META.get('HTTP_AUTHORIZATION', '').split()
+		if len(header) == 2 and header[0].lower() == api_settings.JWT_AUTH_HEADER_PREFIX.lower():
+			fallback = getattr(request, 'user', None)
+			request.user = SimpleLazyObject(lambda: self.resolve(request, fallback))
+		return self.get_response(request)
+
+	def resolve(self, request, fallback):
+		from rest_framework.request import Request
+		try:
+			result = ProfileJSONWebTokenAuthentication().authenticate(Request(request))
+		except exceptions.AuthenticationFailed:
+			result = None
+		if result is None:
+			# not a valid token, leave the request as it was
+			return fallback
+		return result[0]
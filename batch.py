@@ -0,0 +1,168 @@
+import datetime
+
+from django.db import transaction
+
+from . import caching
+from . import models
+from . import popularity
+from . import unlocks
+
+
+OPERATIONS = ('addbookmark', 'removebookmark', 'adddone', 'removedone', 'addlist', 'removelist', 'addrating')
+
+
+class Batch(object):
+	# Runs an ordered list of list / bookmark / rating operations for one profile, with the same outcome as calling
+	# AddBookmark, RemoveBookmark, AddDone, RemoveDone, AddList, RemoveList and AddRating one after another.
+	# Everything the operations touch is read up front with one query per table, the operations are played out in memory,
+	# and only the net changes are written back, with bulk writes, in a single transaction.
+
+	def __init__(self, profile, operations):
+		self.profile = profile
+		self.operations = operations
+
+	def run(self):
+		ops = [self.parse(op) for op in self.operations]
+		with transaction.atomic():
+			self.load(ops)
+			results = [self.apply(op, raw) for op, raw in zip(ops, self.operations)]
+			self.save()
+		caching.bump_profile(self.profile.id)
+		return results
+
+	def parse(self, op):
+		# None for anything malformed, which comes back as a failed result
+		try:
+			parsed = {'op': op['op'], 'id': int(op['id'])}
+			if parsed['op'] == 'addrating':
+				parsed['rating'] = int(op['rating'])
+		except (KeyError, TypeError, ValueError):
+			return None
+		if parsed['op'] not in OPERATIONS:
+			return None
+		return parsed
+
+	def load(self, ops):
+		item_ids = set(op['id'] for op in ops if op)
+		done_ids = set(op['id'] for op in ops if op and op['op'] == 'adddone')
+		self.items = set(models.Item.objects.filter(id__in=item_ids).values_list('id', flat=True))
+		self.places = set(models.Place.objects.filter(pk__in=item_ids).values_list('pk', flat=True))
+		# items that get added to the list when one of the items being marked done is completed
+		self.next = unlocks.next_items_many(done_ids)
+		item_ids = item_ids.union(*self.next.values())
+
+		# what's in the database now, and what each item will look like once the batch has run:
+		# None means no row, 'fresh' means a row that has to be inserted (replacing any that were there before)
+		self.db_todos = {}
+		for item_id, done, added in models.Todo.objects.filter(profile=self.profile, item_id__in=item_ids).values_list('item_id', 'done', 'added'):
+			self.db_todos.setdefault(item_id, {'done': done, 'added': []})['added'].append(added)
+		self.todos = dict((item_id, {'done': row['done'], 'fresh': False}) for item_id, row in self.db_todos.items())
+		self.db_bookmarks = {}
+		for item_id, when in models.Bookmark.objects.filter(profile=self.profile, item_id__in=item_ids).values_list('item_id', 'datetime'):
+			self.db_bookmarks.setdefault(item_id, []).append(when)
+		self.bookmarks = dict((item_id, {'fresh': False, 'refreshed': False}) for item_id in self.db_bookmarks)
+		# lock the user's ratings, like AddRating does, so the aggregate deltas are computed against what we overwrite
+		self.db_ratings = {}
+		for place_id, rating in models.Rating.objects.select_for_update().filter(profile=self.profile, place_id__in=self.places).values_list('place_id', 'rating'):
+			self.db_ratings.setdefault(place_id, []).append(rating)
+		self.ratings = {}
+
+	def apply(self, op, raw):
+		if op is None or op['id'] not in self.items:
+			result = {"success": False}
+			if isinstance(raw, dict) and 'id' in raw:
+				result["id"] = raw['id']
+			return result
+		item_id = op['id']
+		result = {"success": True, "id": item_id}
+		if op['op'] == 'addbookmark':
+			if self.bookmarks.get(item_id):
+				self.bookmarks[item_id]['refreshed'] = True
+			else:
+				self.bookmarks[item_id] = {'fresh': True, 'refreshed': False}
+		elif op['op'] == 'removebookmark':
+			self.bookmarks[item_id] = None
+		elif op['op'] == 'adddone':
+			self.add_todo(item_id, True)
+			for next_id in self.next.get(item_id, []):
+				if not self.todos.get(next_id):
+					self.todos[next_id] = {'done': False, 'fresh': True}
+		elif op['op'] == 'removedone':
+			if self.todos.get(item_id):
+				self.todos[item_id]['done'] = False
+		elif op['op'] == 'addlist':
+			self.add_todo(item_id, False)
+		elif op['op'] == 'removelist':
+			self.todos[item_id] = None
+		elif op['op'] == 'addrating':
+			if item_id not in self.places:
+				return {"success": False, "id": item_id}
+			self.ratings[item_id] = op['rating']
+			result["rating"] = op['rating']
+		return result
+
+	def add_todo(self, item_id, done):
+		if self.todos.get(item_id):
+			self.todos[item_id]['done'] = done
+		else:
+			self.todos[item_id] = {'done': done, 'fresh': True}
+
+	def save(self):
+		now = datetime.datetime.now()
+		profile = self.profile
+
+		# todos
+		delete, create, mark = set(), [], {True: set(), False: set()}
+		for item_id, todo in self.todos.items():
+			if item_id in self.db_todos and (todo is None or todo['fresh']):
+				delete.add(item_id)
+			if todo and todo['fresh']:
+				create.append(models.Todo(profile=profile, item_id=item_id, order=1, done=todo['done']))
+			elif todo and todo['done'] != self.db_todos[item_id]['done']:
+				mark[todo['done']].add(item_id)
+		if delete:
+			models.Todo.objects.filter(profile=profile, item_id__in=delete).delete()
+			popularity.todos_removed(profile, [(item_id, added) for item_id in delete for added in self.db_todos[item_id]['added']])
+		if create:
+			models.Todo.objects.bulk_create(create)
+			popularity.todos_added(profile, [todo.item_id for todo in create])
+		for done, item_ids in mark.items():
+			if item_ids:
+				models.Todo.objects.filter(profile=profile, item_id__in=item_ids).update(done=done)
+
+		# bookmarks
+		delete, create, refresh = set(), [], set()
+		for item_id, bookmark in self.bookmarks.items():
+			if item_id in self.db_bookmarks and (bookmark is None or bookmark['fresh']):
+				delete.add(item_id)
+			if bookmark and bookmark['fresh']:
+				create.append(models.Bookmark(profile=profile, item_id=item_id))
+			elif bookmark and bookmark['refreshed']:
+				refresh.add(item_id)
+		if delete:
+			models.Bookmark.objects.filter(profile=profile, item_id__in=delete).delete()
+			for item_id in delete:
+				for when in self.db_bookmarks[item_id]:
+					popularity.bookmark_removed(profile, item_id, when)
+		if create:
+			models.Bookmark.objects.bulk_create(create)
+			for bookmark in create:
+				popularity.bookmark_added(profile, bookmark.item_id)
+		if refresh:
+			models.Bookmark.objects.filter(profile=profile, item_id__in=refresh).update(datetime=now)
+			for item_id in refresh:
+				popularity.bookmark_added(profile, item_id, self.db_bookmarks[item_id][0])
+
+		# ratings, with the place aggregates kept in step
+		create, change = [], {}
+		for place_id, rating in self.ratings.items():
+			if place_id in self.db_ratings:
+				change.setdefault(rating, set()).add(place_id)
+				models.Place(pk=place_id).add_to_rating(sum(rating - r for r in self.db_ratings[place_id]))
+			else:
+				create.append(models.Rating(profile=profile, place_id=place_id, rating=rating))
+				models.Place(pk=place_id).add_to_rating(rating, 1)
+		if create:
+			models.Rating.objects.bulk_create(create)
+		for rating, place_ids in change.items():
+			models.Rating.objects.filter(profile=profile, place_id__in=place_ids).update(rating=rating)
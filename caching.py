@@ -0,0 +1,124 @@
+import time
+import hashlib
+import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.http import parse_etags
+
+from rest_framework.response import Response
+
+
+# how long a cached /api/me/ payload lives; it's invalidated right away by the user's own changes,
+# this just bounds how stale the parts other people change (like popular items) can get
+ME_CACHE_TIMEOUT = getattr(settings, 'ME_CACHE_TIMEOUT', 60 * 5)
+
+
+def _version_key(profile_id):
+	return 'me:version:%s' % profile_id
+
+
+def _organization_key(organization_id):
+	return 'me:organization:%s' % organization_id
+
+
+def _version(key):
+	version = cache.get(key)
+	if version is None:
+		# start from the clock rather than 1, so a version key that got evicted can't come back and match old payloads
+		cache.add(key, int(time.time() * 1000), None)
+		version = cache.get(key)
+	return version
+
+
+def _bump(key):
+	try:
+		cache.incr(key)
+	except ValueError:
+		cache.set(key, int(time.time() * 1000), None)
+
+
+def profile_version(profile_id):
+	# the current version of a profile's /api/me/ payload
+	return _version(_version_key(profile_id))
+
+
+def bump_profile(profile_id):
+	# called by every endpoint that changes what /api/me/ returns for this profile
+	_bump(_version_key(profile_id))
+
+
+def organization_version(organization_id):
+	# the current version of the organization's snapshot, for every member's /api/me/ payload
+	return _version(_organization_key(organization_id))
+
+
+def bump_organization(organization_id):
+	# called whenever an organization's snapshot is rebuilt
+	_bump(_organization_key(organization_id))
+
+
+def me_key(profile_id, request, organization_id=None):
+	# payloads are keyed by profile, version, organization version and query string
+	params = hashlib.md5(request.GET.urlencode().encode('utf-8')).hexdigest()
+	organization = organization_version(organization_id) if organization_id is not None else None
+	return 'me:%s:%s:%s:%s' % (profile_id, profile_version(profile_id), organization, params)
+
+
+def me_etag(key, *parts):
+	# The /api/me/ ETag. The cache key already covers the profile, the organization snapshot and the query string;
+	# popular items aren't versioned, so the tag also turns over every ME_CACHE_TIMEOUT, like the cached payload.
+	bucket = int(time.time() // ME_CACHE_TIMEOUT) if ME_CACHE_TIMEOUT else None
+	return '"%s"' % hashlib.md5(repr([key, bucket] + list(parts)).encode('utf-8')).hexdigest()
+
+
+def not_modified(request, etag):
+	header = request.META.get('HTTP_IF_NONE_MATCH')
+	return header is not None and (etag in parse_etags(header) or header.strip() == '*')
+
+
+class ETagMixin(object):
+	# Strong ETags for read-only viewsets. The tag is built from the (id, updated) versions of the rows a response is made of,
+	# plus the query string, and the viewer's version for payloads with per-user flags. A matching If-None-Match gets a 304
+	# before any serializer runs.
+	etag_viewer = False
+	# for payloads that depend on the clock, like "Open Now"
+	etag_clock = False
+
+	def etag(self, rows):
+		parts = [self.__class__.__name__, self.request.GET.urlencode()]
+		parts += [(row.pk, row.updated) for row in rows]
+		if self.etag_viewer:
+			try:
+				parts.append(profile_version(self.request.user.profile.id))
+			except Exception:
+				parts.append(None)
+		if self.etag_clock:
+			parts.append(datetime.datetime.now().strftime('%Y%m%d%H%M'))
+		return '"%s"' % hashlib.md5(repr(parts).encode('utf-8')).hexdigest()
+
+	def not_modified(self, etag):
+		return not_modified(self.request, etag)
+
+	def list(self, request, *args, **kwargs):
+		queryset = self.filter_queryset(self.get_queryset())
+		page = self.paginate_queryset(queryset)
+		rows = page if page is not None else list(queryset)
+		etag = self.etag(rows)
+		if self.not_modified(etag):
+			return Response(status=304, headers={'ETag': etag})
+		serializer = self.get_serializer(rows, many=True)
+		if page is not None:
+			response = self.get_paginated_response(serializer.data)
+		else:
+			response = Response(serializer.data)
+		response['ETag'] = etag
+		return response
+
+	def retrieve(self, request, *args, **kwargs):
+		instance = self.get_object()
+		etag = self.etag([instance])
+		if self.not_modified(etag):
+			return Response(status=304, headers={'ETag': etag})
+		serializer = self.get_serializer(instance)
+		return Response(serializer.data, headers={'ETag': etag})
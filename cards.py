@@ -0,0 +1,242 @@
+from django.core.exceptions import FieldDoesNotExist
+from django.core.files.storage import FileSystemStorage
+from django.utils.encoding import filepath_to_uri
+from django.utils.functional import cached_property
+
+from rest_framework import serializers, relations
+from rest_framework.settings import api_settings
+
+from . import distances
+from . import fieldsets
+from . import models
+from . import viewer
+
+
+# A card renderer reads a list of items with values(), instead of building a model instance and a serializer per row,
+# and turns the rows into the same dicts the card serializers in api.py make. The keys, their order and how each value
+# is represented are taken from the serializer's own fields, so the JSON comes out the same; only the SerializerMethodFields
+# are written out again here, as functions of a row.
+
+
+def file_url(storage):
+	# FileSystemStorage urls are just the storage's base url and the file name, so skip the per-call urljoin
+	if isinstance(storage, FileSystemStorage):
+		prefix = storage.base_url
+		return lambda name: prefix + filepath_to_uri(name).lstrip('/')
+	return storage.url
+
+
+def _is_method(field):
+	return isinstance(field, serializers.SerializerMethodField)
+
+
+class Context(object):
+	# what a render call knows about the request, shared by every row
+
+	def __init__(self, request, viewer=None):
+		self.request = request
+		if viewer is not None:
+			# render for someone other than the request's user
+			self.__dict__['viewer'] = viewer
+
+	@cached_property
+	def viewer(self):
+		# only loaded if a card has a field that needs it
+		return viewer.for_request(self.request)
+
+	@cached_property
+	def location(self):
+		try:
+			return self.request.user.profile.location
+		except:
+			return None
+
+
+# SerializerMethodFields, as (columns they read, function of (card, row, context)), where the columns are relative to the item
+def _image(card, row, ctx):
+	name = row[card.prefix + 'image']
+	return card.image_url(name) if name else None
+
+
+def _article(card, row, ctx):
+	content = row[card.prefix + 'content']
+	return True if content != "" and content != None else False
+
+
+def _items(card, row, ctx):
+	return row[card.prefix + 'group__item_count'] if row[card.prefix + 'is_group'] else 0
+
+
+def _rating(card, row, ctx):
+	return row[card.prefix + 'place__rating_avg'] if row[card.prefix + 'is_place'] else None
+
+
+def _km(card, row, ctx):
+	# great circle distances for the whole page are worked out in one pass, the first time a row asks for one
+	if ctx.distances is None:
+		ctx.distances = card.page_distances(ctx.rows, ctx)
+	return ctx.distances.get(id(row))
+
+
+METHODS = {
+	'image': (('image',), _image),
+	'article': (('content',), _article),
+	'place': (('is_place',), lambda card, row, ctx: row[card.prefix + 'is_place']),
+	'group': (('is_group',), lambda card, row, ctx: row[card.prefix + 'is_group']),
+	'items': (('is_group', 'group__item_count'), _items),
+	'rating': (('is_place', 'place__rating_avg'), _rating),
+	'distance': (('is_place', 'place__location'), lambda card, row, ctx: distances.miles(_km(card, row, ctx))),
+	'distance_km': (('is_place', 'place__location'), lambda card, row, ctx: distances.tenths(_km(card, row, ctx))),
+	'bookmarked': ((), lambda card, row, ctx: ctx.viewer.bookmarked(row[card.id_column])),
+	'done': ((), lambda card, row, ctx: ctx.viewer.done(row[card.id_column])),
+	'todo': ((), lambda card, row, ctx: ctx.viewer.todo(row[card.id_column])),
+	# not a column, it's put on the rows by whoever read the scores
+	'score': ((), lambda card, row, ctx: row['score']),
+}
+
+# BookmarkSerializer and PopSerializer say everything is bookmarked
+ALWAYS_BOOKMARKED = {'bookmarked': ((), lambda card, row, ctx: True)}
+
+
+class Card(object):
+
+	def __init__(self, serializer_class, model=models.Item, prefix='', methods=None):
+		# serializer_class: the serializer whose output this reproduces
+		# model: what the rows are read from, and prefix: the path from that model to the item, like 'item__' for Todo rows
+		self.serializer_class = serializer_class
+		self.model = model
+		self.prefix = prefix
+		self.id_column = prefix + 'id'
+		self.methods = dict(METHODS, **(methods or {}))
+		self.image_url = file_url(models.Item._meta.get_field('image').storage)
+
+	def _model_field(self, attrs):
+		# the model field at the end of a source path from the row model, None if the path doesn't exist
+		model, field = self.model, None
+		for attr in attrs:
+			try:
+				field = model._meta.get_field(attr)
+			except (FieldDoesNotExist, AttributeError):
+				return None
+			model = field.related_model
+		return field
+
+	def _resolves(self, attrs):
+		# if the path doesn't exist on the row model, the serializer would skip the field for these rows too
+		return self._model_field(attrs) is not None
+
+	@cached_property
+	def compiled(self):
+		# [(key, function of (row, context), columns it reads, m2m list it needs)], in the serializer's order
+		compiled = []
+		for name, field in self.serializer_class().fields.items():
+			if _is_method(field):
+				method_columns, method = self.methods[name]
+				compiled.append((name, self._method(method), [self.prefix + c for c in method_columns], None))
+			elif isinstance(field, serializers.ListSerializer) or isinstance(field, relations.ManyRelatedField):
+				if self._resolves(field.source_attrs):
+					relation = self._relation(field)
+					compiled.append((name, self._list(relation), [relation['owner']], relation))
+			elif self._resolves(field.source_attrs):
+				column = '__'.join(field.source_attrs)
+				compiled.append((name, self._value(field, column, self._model_field(field.source_attrs)), [column], None))
+		return compiled
+
+	def select(self, selection):
+		# the part of compiled a selection (see fieldsets.py) keeps, and the columns that needs
+		if selection == fieldsets.EVERYTHING:
+			chosen = self.compiled
+		else:
+			chosen = [c for c in self.compiled if fieldsets.keep(selection, c[0])]
+		columns = set([self.id_column])
+		for name, get, field_columns, relation in chosen:
+			columns.update(field_columns)
+		return chosen, sorted(columns)
+
+	def _method(self, method):
+		return lambda row, ctx: method(self, row, ctx)
+
+	def _value(self, field, column, model_field):
+		if isinstance(field, serializers.FileField):
+			url = file_url(model_field.storage)
+			use_url = getattr(field, 'use_url', api_settings.UPLOADED_FILES_USE_URL)
+
+			def get(row, ctx):
+				# same as FileField.to_representation, from the stored file name
+				name = row[column]
+				if not name:
+					return None
+				if not use_url:
+					return name
+				u = url(name)
+				return ctx.request.build_absolute_uri(u) if ctx.request is not None else u
+			return get
+
+		def get(row, ctx):
+			value = row[column]
+			return None if value is None else field.to_representation(value)
+		return get
+
+	def _relation(self, field):
+		# how to load an m2m field like tags or ctas for every row in one query
+		attrs = field.source_attrs
+		owner_column = '__'.join(attrs[:-1] + ['id'])
+		owner_model = self.model
+		for attr in attrs[:-1]:
+			owner_model = owner_model._meta.get_field(attr).related_model
+		m2m_field = owner_model._meta.get_field(attrs[-1])
+		through = m2m_field.remote_field.through
+		source, target = m2m_field.m2m_field_name(), m2m_field.m2m_reverse_field_name()
+		relation = {'owner': owner_column, 'through': through, 'source': source, 'target': target, 'child': None}
+		if isinstance(field, serializers.ListSerializer):
+			# nested serializer, like tags as {name, id}: [(key, field, column on the through table)]; otherwise a list of primary keys
+			relation['child'] = [(name, f, target + '__' + '__'.join(f.source_attrs)) for name, f in field.child.fields.items()]
+		return relation
+
+	def _list(self, relation):
+		return lambda row, ctx: ctx.lists[id(relation)].get(row[relation['owner']], [])
+
+	def _load(self, relation, rows, selection):
+		# {owner id: [values]} for every row, in one query
+		owners = set(row[relation['owner']] for row in rows)
+		if not owners:
+			return {}
+		through = relation['through'].objects.filter(**{relation['source'] + '_id__in': owners}).order_by('pk')
+		lists = {}
+		if relation['child'] is None:
+			for owner, pk in through.values_list(relation['source'] + '_id', relation['target'] + '_id'):
+				lists.setdefault(owner, []).append(pk)
+			return lists
+		child = [c for c in relation['child'] if fieldsets.keep(selection, c[0])]
+		for values in through.values_list(relation['source'] + '_id', *[column for name, f, column in child]):
+			lists.setdefault(values[0], []).append(dict(
+				(name, None if v is None else f.to_representation(v)) for (name, f, column), v in zip(child, values[1:])
+			))
+		return lists
+
+	def rows(self, queryset, selection=fieldsets.EVERYTHING):
+		# the values() rows for a queryset of the row model
+		chosen, columns = self.select(selection)
+		return list(queryset.values(*columns))
+
+	def render(self, rows, request, selection=fieldsets.EVERYTHING, viewer=None):
+		chosen, columns = self.select(selection)
+		ctx = Context(request, viewer)
+		ctx.rows = rows
+		ctx.distances = None
+		ctx.lists = {}
+		for name, get, field_columns, relation in chosen:
+			if relation is not None:
+				ctx.lists[id(relation)] = self._load(relation, rows, fieldsets.child(selection, name))
+		return [dict((name, get(row, ctx)) for name, get, field_columns, relation in chosen) for row in rows]
+
+	def page_distances(self, rows, ctx):
+		# {id(row): km from the viewer} for the rows that are places with a location, the viewer's location read once
+		located = [row for row in rows if row[self.prefix + 'is_place'] and row[self.prefix + 'place__location'] is not None]
+		if ctx.location is None or not located:
+			return {}
+		km = distances.haversine_km(ctx.location, [(row[self.prefix + 'place__location'].x, row[self.prefix + 'place__location'].y) for row in located])
+		return dict((id(row), float(d)) for row, d in zip(located, km))
+
+	def list(self, queryset, request, selection=fieldsets.EVERYTHING):
+		return self.render(self.rows(queryset, selection), request, selection)
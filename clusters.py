@@ -0,0 +1,71 @@
+import math
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+
+from . import models
+
+
+# zoom levels clusters are built for, requests outside of them use the nearest one
+MIN_ZOOM = getattr(settings, 'CLUSTER_MIN_ZOOM', 3)
+MAX_ZOOM = getattr(settings, 'CLUSTER_MAX_ZOOM', 16)
+# cells per map tile along each side, so a 256px tile is split into 64px cells
+CELLS_PER_TILE = 4
+# web mercator stops here
+MAX_LATITUDE = 85.05112878
+
+
+def cell(latitude, longitude, zoom):
+	# (x, y) of the grid cell a point falls in at this zoom, on the web mercator tile grid the map uses
+	n = 2 ** zoom * CELLS_PER_TILE
+	latitude = max(min(latitude, MAX_LATITUDE), -MAX_LATITUDE)
+	x = int((longitude + 180.0) / 360.0 * n)
+	y = int((1.0 - math.asinh(math.tan(math.radians(latitude))) / math.pi) / 2.0 * n)
+	return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def clamp_zoom(zoom):
+	return min(max(zoom, MIN_ZOOM), MAX_ZOOM)
+
+
+def build(metro):
+	# rebuild every zoom level of a metro's clusters, for all of its places and for each category, in one transaction
+	places = list(models.Place.objects.filter(metro=metro, public=True, location__isnull=False).values_list('pk', 'location', 'featured', 'rating_avg'))
+	categories = {}
+	for place_id, category_id in models.Place.category.through.objects.filter(place_id__in=[p[0] for p in places]).values_list('place_id', 'category_id'):
+		categories.setdefault(place_id, []).append(category_id)
+	rows = []
+	for zoom in range(MIN_ZOOM, MAX_ZOOM + 1):
+		cells = {}
+		for place_id, location, featured, rating in places:
+			# Point(latitude, longitude)
+			x, y = cell(location.x, location.y, zoom)
+			for category_id in [None] + categories.get(place_id, []):
+				cells.setdefault((category_id, x, y), []).append((place_id, location, featured, rating))
+		for (category_id, x, y), members in cells.items():
+			# featured places first, then the best rated, then the oldest
+			best = min(members, key=lambda m: (not m[2], -(m[3] or 0), m[0]))
+			rows.append(models.PlaceCluster(
+				metro_id=metro.pk, category_id=category_id, zoom=zoom, cell_x=x, cell_y=y, count=len(members),
+				latitude=sum(m[1].x for m in members) / len(members), longitude=sum(m[1].y for m in members) / len(members),
+				place_id=best[0],
+			))
+	with transaction.atomic():
+		models.PlaceCluster.objects.filter(metro=metro).delete()
+		models.PlaceCluster.objects.bulk_create(rows, batch_size=1000)
+	return len(rows)
+
+
+def query(metro_id, zoom, south, west, north, east, category_id=None):
+	# the clusters inside a bounding box: an index range scan over the cells it covers
+	zoom = clamp_zoom(zoom)
+	x0, y0 = cell(north, west, zoom)
+	x1, y1 = cell(south, east, zoom)
+	qs = models.PlaceCluster.objects.filter(metro=metro_id, category=category_id, zoom=zoom, cell_y__gte=y0, cell_y__lte=y1)
+	if west <= east:
+		qs = qs.filter(cell_x__gte=x0, cell_x__lte=x1)
+	else:
+		# the box crosses the antimeridian
+		qs = qs.filter(Q(cell_x__gte=x0) | Q(cell_x__lte=x1))
+	return zoom, qs.values('count', 'latitude', 'longitude', 'place_id', 'place__name')
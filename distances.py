@@ -0,0 +1,30 @@
+import math
+
+import numpy
+
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_MILE = 1.609344
+
+
+def haversine_km(origin, points):
+	# Great circle distances in km from origin to each of points, in one vectorized pass.
+	# Locations are stored as Point(latitude, longitude), so origin is one of those and points are (latitude, longitude) pairs.
+	if origin is None or not points:
+		return numpy.full(len(points), numpy.nan)
+	coordinates = numpy.radians(numpy.asarray(points, dtype=float))
+	latitude, longitude = coordinates[:, 0], coordinates[:, 1]
+	origin_latitude, origin_longitude = math.radians(origin.x), math.radians(origin.y)
+	h = numpy.sin((latitude - origin_latitude) / 2) ** 2 + math.cos(origin_latitude) * numpy.cos(latitude) * numpy.sin((longitude - origin_longitude) / 2) ** 2
+	return 2 * EARTH_RADIUS_KM * numpy.arcsin(numpy.minimum(1, numpy.sqrt(h)))
+
+
+def tenths(value):
+	# distances are shown truncated to a tenth, None when unknown
+	if value is None or math.isnan(value):
+		return None
+	return int( value * 10 ) / 10
+
+
+def miles(km):
+	return tenths(None if km is None else km / KM_PER_MILE)
@@ -0,0 +1,91 @@
+from rest_framework import serializers
+
+
+# Sparse fieldsets: ?fields=id,name,location keeps only those fields, ?omit=openhours,rating drops those.
+# Dotted paths reach into nested parts of a response, like ?omit=organization.popular on /api/me/.
+# Fields that are left out are never computed, so a left out SerializerMethodField runs none of its queries.
+#
+# A selection is an (include, exclude) pair of trees, {field name: subtree}, where a subtree of None means the whole field.
+# An include of None means everything.
+
+EVERYTHING = (None, {})
+
+
+def parse(value):
+	tree = {}
+	for path in value.split(','):
+		parts = [part.strip() for part in path.split('.')]
+		if not all(parts):
+			continue
+		node = tree
+		for i, part in enumerate(parts):
+			if part in node and node[part] is None:
+				# all of it is already in
+				break
+			if i == len(parts) - 1:
+				node[part] = None
+			else:
+				node = node.setdefault(part, {})
+	return tree
+
+
+def from_request(request):
+	if request is None:
+		return EVERYTHING
+	params = getattr(request, 'query_params', request.GET)
+	fields = ','.join(params.getlist('fields'))
+	return (parse(fields) if fields else None, parse(','.join(params.getlist('omit'))))
+
+
+def keep(selection, name):
+	include, exclude = selection
+	if include is not None and name not in include:
+		return False
+	return not (name in exclude and exclude[name] is None)
+
+
+def child(selection, name):
+	# the selection inside one field
+	include, exclude = selection
+	return (include.get(name) if include is not None else None, exclude.get(name) or {})
+
+
+class SparseFieldsMixin(object):
+	# Serializer mixin: drops the fields the request's selection leaves out, and hands each nested serializer its part of it.
+	# Serializers built by hand inside a SerializerMethodField get theirs through child_context().
+
+	@property
+	def selection(self):
+		selection = getattr(self, '_selection', None)
+		if selection is not None:
+			return selection
+		parent = self.parent
+		if isinstance(parent, serializers.ListSerializer):
+			parent = parent.parent
+		if parent is not None:
+			# nested in something that doesn't pass a selection down
+			return EVERYTHING
+		if 'fieldsets' in self.context:
+			return self.context['fieldsets']
+		return from_request(self.context.get('request'))
+
+	def child_selection(self, name):
+		return child(self.selection, name)
+
+	def child_context(self, name):
+		return dict(self.context, fieldsets=self.child_selection(name))
+
+	def get_fields(self):
+		fields = super(SparseFieldsMixin, self).get_fields()
+		selection = self.selection
+		if selection == EVERYTHING:
+			return fields
+		for name in list(fields):
+			if not keep(selection, name):
+				del fields[name]
+				continue
+			field = fields[name]
+			nested = field.child if isinstance(field, serializers.ListSerializer) else field
+			if isinstance(nested, SparseFieldsMixin):
+				nested._selection = child(selection, name)
+		return fields
@@ -0,0 +1,89 @@
+import hashlib
+import logging
+
+from django.conf import settings
+from django.contrib.gis.geos import Point
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from geopy import geocoders
+from geopy.exc import GeopyError
+
+from . import models
+
+
+logger = logging.getLogger(__name__)
+
+
+class Geocoder(object):
+	# Geocoder backends take a list of normalized addresses and return {address: Point or None}.
+	# None means the address couldn't be found, leave an address out to have it retried on the next run.
+
+	def geocode(self, addresses):
+		raise NotImplementedError
+
+
+class GoogleGeocoder(Geocoder):
+
+	def __init__(self):
+		self.geocoder = geocoders.GoogleV3(api_key=getattr(settings, 'GOOGLE_GEOCODING_API_KEY', None))
+
+	def geocode(self, addresses):
+		results = {}
+		for address in addresses:
+			try:
+				l = self.geocoder.geocode(address)
+			except GeopyError as e:
+				logger.warning("geocoding error for %s: %s", address, e)
+				continue
+			results[address] = Point(l.latitude, l.longitude) if l else None
+		return results
+
+
+class OfflineGeocoder(Geocoder):
+	# Stand-in for tests and development: derives a stable point in the continental US from the address, never touches the network
+
+	def geocode(self, addresses):
+		results = {}
+		for address in addresses:
+			digest = hashlib.md5(address.encode('utf-8')).digest()
+			latitude = 25 + (digest[0] * 256 + digest[1]) / 65535.0 * 24
+			longitude = -124 + (digest[2] * 256 + digest[3]) / 65535.0 * 57
+			results[address] = Point(latitude, longitude)
+		return results
+
+
+def get_geocoder():
+	return import_string(getattr(settings, 'GEOCODER_BACKEND', 'newto_django.geocoding.GoogleGeocoder'))()
+
+
+def process_pending(batch_size=100, geocoder=None):
+	# Geocode every place waiting on a location, batch_size places at a time.
+	# Identical addresses in a batch are geocoded once, and anything already in GeocodeCache isn't geocoded at all.
+	if geocoder is None:
+		geocoder = get_geocoder()
+	processed = 0
+	last = 0
+	while True:
+		places = list(models.Place.objects.filter(geocode_pending=True, pk__gt=last).order_by('pk').only('pk', 'address', 'city', 'state')[:batch_size])
+		if not places:
+			return processed
+		last = places[-1].pk
+		by_address = {}
+		for place in places:
+			by_address.setdefault(models.GeocodeCache.normalize(place.full_address()), []).append(place.pk)
+		cached = dict(models.GeocodeCache.objects.filter(address__in=by_address.keys()).values_list('address', 'location'))
+		missing = [address for address in by_address if address not in cached]
+		if missing:
+			found = geocoder.geocode(missing)
+			try:
+				with transaction.atomic():
+					models.GeocodeCache.objects.bulk_create([models.GeocodeCache(address=a, location=l) for a, l in found.items()])
+			except IntegrityError:
+				# another worker got to some of these first, their answer is as good as ours
+				pass
+			cached.update(found)
+		for address, ids in by_address.items():
+			if address in cached:
+				processed += models.Place.objects.filter(pk__in=ids, location__isnull=True).update(location=cached[address], geocode_pending=False, updated=timezone.now())
@@ -0,0 +1,108 @@
+import math
+import time
+import atexit
+import logging
+import threading
+
+from django.conf import settings
+from django.contrib.gis.db.models import PointField
+from django.contrib.gis.geos import Point
+from django.db import connections
+from django.db.models import Case, When, Value
+
+from . import caching
+from . import models
+
+
+logger = logging.getLogger(__name__)
+
+# GPS pings that moved less than this from the last stored (or buffered) fix are dropped
+MIN_MOVEMENT_METERS = getattr(settings, 'LOCATION_MIN_MOVEMENT_METERS', 25)
+# buffered fixes are written out once the oldest flush is this old, or once this many profiles are waiting
+FLUSH_INTERVAL = getattr(settings, 'LOCATION_FLUSH_INTERVAL', 30)
+FLUSH_SIZE = getattr(settings, 'LOCATION_FLUSH_SIZE', 500)
+
+EARTH_RADIUS_METERS = 6371008.8
+
+# Location pings are buffered per process, keeping only the latest fix per profile, and written in bulk:
+# one UPDATE of just the location column for up to FLUSH_SIZE profiles, instead of a profile.save() per ping.
+# A timer flushes whatever is waiting FLUSH_INTERVAL seconds after it came in, even if no more pings arrive,
+# so at most that much is lost if a worker is killed outright (atexit covers a clean shutdown).
+_lock = threading.Lock()
+_pending = {}
+_last_flush = time.time()
+_timer = None
+
+
+def distance(a, b):
+	# haversine distance in metres between two Point(latitude, longitude)s
+	lat1, lng1, lat2, lng2 = map(math.radians, (a.x, a.y, b.x, b.y))
+	h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+	return 2 * EARTH_RADIUS_METERS * math.asin(min(1, math.sqrt(h)))
+
+
+def record(profile, latitude, longitude):
+	# buffer a fix for this profile, returns False if it was dropped for being too close to the last one
+	point = Point(latitude, longitude)
+	with _lock:
+		last = _pending.get(profile.id, profile.location)
+		if last is not None and distance(last, point) < MIN_MOVEMENT_METERS:
+			return False
+		_pending[profile.id] = point
+		_schedule()
+		due = len(_pending) >= FLUSH_SIZE or time.time() - _last_flush >= FLUSH_INTERVAL
+	if due:
+		flush()
+	return True
+
+
+def flush():
+	# write every buffered fix, returns how many profiles were updated
+	global _last_flush
+	with _lock:
+		pending = dict(_pending)
+		_pending.clear()
+		_last_flush = time.time()
+	ids = sorted(pending)
+	try:
+		for i in range(0, len(ids), FLUSH_SIZE):
+			chunk = ids[i:i + FLUSH_SIZE]
+			location = Case(*[When(pk=pk, then=Value(pending[pk], output_field=PointField())) for pk in chunk], output_field=PointField())
+			models.Profile.objects.filter(pk__in=chunk).update(location=location)
+	except Exception:
+		logger.exception("couldn't flush %d buffered locations", len(ids))
+		# put them back for the next flush, unless a newer fix came in meanwhile
+		with _lock:
+			for pk in ids:
+				_pending.setdefault(pk, pending[pk])
+		return 0
+	for pk in ids:
+		caching.bump_profile(pk)
+	return len(ids)
+
+
+def _schedule():
+	# start the flush timer if it isn't running, called with _lock held
+	global _timer
+	if _timer is None:
+		_timer = threading.Timer(FLUSH_INTERVAL, _timed_flush)
+		_timer.daemon = True
+		_timer.start()
+
+
+def _timed_flush():
+	global _timer
+	with _lock:
+		_timer = None
+	try:
+		flush()
+	finally:
+		# the timer thread's own connections, nothing else closes them
+		connections.close_all()
+	with _lock:
+		if _pending:
+			# came in during the flush, or put back after a failed one
+			_schedule()
+
+
+atexit.register(flush)
@@ -0,0 +1,138 @@
+import os
+import json
+import time
+import random
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from rest_framework.request import Request
+
+from ... import api
+from ... import models
+from ... import unlocks
+from .generate_synthetic_data import generate, PREFIX, USERNAME_PREFIX
+
+
+BUDGET_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'benchmark_budget.json')
+
+PAGE_SIZE = 50
+
+
+class Rollback(Exception):
+	pass
+
+
+def _request(user, path):
+	request = Request(RequestFactory().get(path))
+	request.user = user
+	return request
+
+
+def bench_me(profile, request):
+	queryset = models.Profile.objects.filter(user=profile.user_id)
+	return api.MeSerializer(queryset, many=True, context={'request': request}).data
+
+
+def bench_popular(profile, request):
+	organization = profile.organization
+	return api.OrganizationSerializer(organization, context={'request': request}).get_popular(organization)
+
+
+def bench_place(profile, request):
+	queryset = api.PlaceFilter(request.GET, queryset=models.Place.objects.all(), request=request).qs
+	return api.PlaceSerializer(queryset.order_by('id')[:PAGE_SIZE], many=True, context={'request': request}).data
+
+
+def bench_group(profile, request):
+	return api.GroupSerializer(models.Group.objects.order_by('id')[:PAGE_SIZE], many=True, context={'request': request}).data
+
+
+# name: (function, path of the endpoint it stands in for)
+BENCHMARKS = (
+	('me', bench_me, '/api/me/'),
+	('popular', bench_popular, '/api/organization/'),
+	('place', bench_place, '/api/place/'),
+	('group', bench_group, '/api/group/'),
+)
+
+
+class Command(BaseCommand):
+	help = ("Time MeSerializer, OrganizationSerializer.get_popular, PlaceSerializer and GroupSerializer, and count their queries, "
+		"against synthetic data at several scales. Fails if a query count grows with the scale, or goes over the recorded budget. "
+		"The synthetic data is made inside a transaction that's rolled back, but use a development database anyway.")
+
+	def add_arguments(self, parser):
+		parser.add_argument('--scales', type=int, nargs='+', default=[1, 10, 100])
+		parser.add_argument('--repeat', type=int, default=5, help="Timed runs per serializer and scale.")
+		parser.add_argument('--budget', default=BUDGET_PATH, help="Query count budget file.")
+		parser.add_argument('--record', action='store_true', help="Write the query counts from this run to the budget file instead of checking them.")
+
+	def handle(self, *args, **options):
+		if models.Metro.objects.filter(name__startswith=PREFIX).exists():
+			raise CommandError("There's synthetic data here already, remove it with generate_synthetic_data --flush first.")
+		budget = {}
+		if os.path.exists(options['budget']):
+			with open(options['budget']) as f:
+				budget = json.load(f)
+		elif not options['record']:
+			self.stdout.write("No budget at %s yet, only checking that query counts don't grow with the scale; run with --record to make one." % options['budget'])
+
+		results = {}
+		for scale in options['scales']:
+			self.stdout.write("Generating %dx data..." % scale)
+			for name, queries, seconds in self.run_scale(scale, max(options['repeat'], 1)):
+				results.setdefault(name, {})[str(scale)] = queries
+				self.stdout.write("  %-8s %4dx %5d queries %9.1f ms %9.1f calls/s" % (name, scale, queries, seconds * 1000, 1 / seconds if seconds else 0))
+
+		if options['record']:
+			for name, counts in results.items():
+				budget.setdefault(name, {}).update(counts)
+			with open(options['budget'], 'w') as f:
+				json.dump(budget, f, indent=2, sort_keys=True)
+				f.write('\n')
+			self.stdout.write("Recorded the query budget in %s." % options['budget'])
+			return
+
+		failures = []
+		for name, counts in sorted(results.items()):
+			# a count that goes up with the amount of data is a query per row somewhere, budget or not
+			by_scale = sorted((int(scale), queries) for scale, queries in counts.items())
+			if by_scale and by_scale[-1][1] > by_scale[0][1]:
+				failures.append("%s made %d queries at %dx but %d at %dx" % (name, by_scale[0][1], by_scale[0][0], by_scale[-1][1], by_scale[-1][0]))
+			for scale, queries in sorted(counts.items()):
+				allowed = budget.get(name, {}).get(scale)
+				if allowed is None:
+					self.stdout.write("No budget for %s at %sx, run with --record to add it." % (name, scale))
+				elif queries > allowed:
+					failures.append("%s at %sx made %d queries, the budget is %d" % (name, scale, queries, allowed))
+		if failures:
+			raise CommandError("Query count regressions:\n  " + "\n  ".join(failures))
+		self.stdout.write("All query counts are within budget.")
+
+	def run_scale(self, scale, repeat):
+		# returns [(name, queries, median seconds per call)]; the most queries any run made counts
+		results = []
+		try:
+			with transaction.atomic():
+				generate(scale, random.Random(0))
+				profile = models.Profile.objects.filter(user__username__startswith=USERNAME_PREFIX).select_related('user', 'organization').order_by('pk').first()
+				for name, bench, path in BENCHMARKS:
+					queries, timings = 0, []
+					for i in range(repeat):
+						# a new request every time, so nothing memoized on it carries over between runs
+						request = _request(profile.user, path)
+						with CaptureQueriesContext(connection) as captured:
+							start = time.perf_counter()
+							bench(profile, request)
+							timings.append(time.perf_counter() - start)
+						queries = max(queries, len(captured))
+					results.append((name, queries, sorted(timings)[len(timings) // 2]))
+				raise Rollback
+		except Rollback:
+			pass
+		finally:
+			unlocks.invalidate()
+		return results
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from ... import clusters
+from ... import models
+
+
+class Command(BaseCommand):
+	help = "Rebuild the map clusters of every metro's places. Run periodically, clusters don't follow place edits on their own."
+
+	def add_arguments(self, parser):
+		parser.add_argument('--metro', type=int, help="Only rebuild this metro.")
+
+	def handle(self, *args, **options):
+		metros = models.Metro.objects.all()
+		if options['metro']:
+			metros = metros.filter(pk=options['metro'])
+		for metro in metros:
+			count = clusters.build(metro)
+			self.stdout.write("Built %d clusters for %s." % (count, metro))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from ... import models
+from ... import popularity
+
+
+class Command(BaseCommand):
+	help = "Rebuild the time-decayed popularity leaderboards from Todo and Bookmark. Run periodically, e.g. nightly from cron."
+
+	def add_arguments(self, parser):
+		parser.add_argument('--organization', type=int, help="Only rebuild this organization's leaderboard and its metro's.")
+
+	def handle(self, *args, **options):
+		organization = None
+		if options['organization']:
+			organization = models.Organization.objects.get(pk=options['organization'])
+		popularity.compact(organization)
+		self.stdout.write("Compacted %d leaderboard rows." % models.Popularity.objects.count())
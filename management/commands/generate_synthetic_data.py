@@ -0,0 +1,209 @@
+import io
+import random
+import datetime
+
+from django.contrib.auth.models import User
+from django.contrib.auth.hashers import make_password
+from django.contrib.gis.geos import Point
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from openinghours.models import OpeningHours
+
+from ... import models
+from ... import popularity
+from ... import postings
+from ... import search
+from ... import snapshots
+from ... import unlocks
+
+
+# everything this command makes is named with this prefix, so it can be found and flushed again
+PREFIX = 'Synthetic'
+USERNAME_PREFIX = 'synthetic-'
+
+# how much of everything one unit of --scale makes
+PER_SCALE = {
+	'metros': 1,
+	'organizations': 2,
+	'items': 100,
+	'groups': 10,
+	'places': 200,
+	'profiles': 50,
+}
+GROUP_SIZE = 8
+TODOS_PER_PROFILE = 20
+BOOKMARKS_PER_PROFILE = 10
+RATINGS_PER_PROFILE = 5
+TIPS_PER_ORGANIZATION = 5
+CATEGORIES = 10
+TAGS = 30
+STATES = ('NY', 'CA', 'IL', 'TX', 'WA', 'MA', 'CO', 'GA')
+WORDS = ('coffee', 'park', 'museum', 'library', 'market', 'gym', 'bakery', 'pharmacy', 'clinic', 'bank', 'trail', 'theater',
+	'bookstore', 'garden', 'pool', 'bar', 'taco', 'pizza', 'noodle', 'transit', 'laundry', 'hardware', 'yoga', 'music')
+
+
+class Command(BaseCommand):
+	help = "Fill the database with synthetic organizations, metros, places, items, groups and profiles, for benchmarking. Don't run this against production."
+
+	def add_arguments(self, parser):
+		parser.add_argument('--scale', type=int, default=1, help="Multiplier for the amount of data, 1 makes %d places and %d profiles." % (PER_SCALE['places'], PER_SCALE['profiles']))
+		parser.add_argument('--seed', type=int, default=0)
+		parser.add_argument('--flush', action='store_true', help="Remove synthetic data from an earlier run first.")
+
+	def handle(self, *args, **options):
+		if options['scale'] < 1:
+			raise CommandError("--scale must be at least 1.")
+		if options['flush']:
+			flush()
+		elif models.Metro.objects.filter(name__startswith=PREFIX).exists():
+			raise CommandError("There's synthetic data here already, use --flush to replace it.")
+		with transaction.atomic():
+			counts = generate(options['scale'], random.Random(options['seed']))
+		self.stdout.write("Generated %s." % ", ".join("%d %s" % (n, name) for name, n in counts))
+
+
+def flush():
+	models.Item.objects.filter(name__startswith=PREFIX).delete()
+	User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+	models.Organization.objects.filter(name__startswith=PREFIX).delete()
+	models.Metro.objects.filter(name__startswith=PREFIX).delete()
+	models.Category.objects.filter(name__startswith=PREFIX).delete()
+	models.Tag.objects.filter(name__startswith=PREFIX).delete()
+	models.Tip.objects.filter(name__startswith=PREFIX).delete()
+	unlocks.invalidate()
+
+
+def _name(rng, n=2):
+	return ' '.join(rng.choice(WORDS) for i in range(n)).title()
+
+
+def _near(rng, center, spread=0.2):
+	# Point(latitude, longitude), the way the rest of the app stores locations
+	return Point(center[0] + rng.uniform(-spread, spread), center[1] + rng.uniform(-spread, spread))
+
+
+def generate(scale, rng):
+	n = dict((k, v * scale) for k, v in PER_SCALE.items())
+
+	tags = models.Tag.objects.bulk_create([models.Tag(name='%s %s %d' % (PREFIX, rng.choice(WORDS), i)) for i in range(TAGS)])
+	categories = models.Category.objects.bulk_create([models.Category(name='%s %s %d' % (PREFIX, rng.choice(WORDS).title(), i)) for i in range(CATEGORIES)])
+	models.Category.tags.through.objects.bulk_create([
+		models.Category.tags.through(category_id=c.pk, tag_id=t.pk) for c in categories for t in rng.sample(tags, 4)
+	])
+
+	metros = models.Metro.objects.bulk_create([models.Metro(name='%s Metro %d' % (PREFIX, i)) for i in range(n['metros'])])
+	centers = dict((m.pk, (rng.uniform(30, 45), rng.uniform(-120, -75))) for m in metros)
+	organizations = models.Organization.objects.bulk_create([
+		models.Organization(name='%s Organization %d' % (PREFIX, i), metro=metros[i % len(metros)], nav_name=_name(rng)) for i in range(n['organizations'])
+	])
+
+	# items, some of them unlocking the next one when completed, which keeps Item.next free of cycles
+	items = models.Item.objects.bulk_create([
+		models.Item(name='%s %s' % (PREFIX, _name(rng, 3)), content=' '.join(rng.choice(WORDS) for w in range(rng.randint(0, 40))), public=rng.random() < 0.8)
+		for i in range(n['items'])
+	])
+	models.Item.tags.through.objects.bulk_create([
+		models.Item.tags.through(item_id=item.pk, tag_id=t.pk) for item in items for t in rng.sample(tags, rng.randint(0, 4))
+	])
+	models.Item.next.through.objects.bulk_create([
+		models.Item.next.through(from_item_id=a.pk, to_item_id=b.pk) for a, b in zip(items, items[1:]) if rng.random() < 0.1
+	])
+
+	# groups can't be bulk created, they're a table of their own on top of Item
+	groups = []
+	for i in range(n['groups']):
+		group = models.Group(name='%s %s Group' % (PREFIX, _name(rng)), public=True)
+		group.save()
+		groups.append(group)
+	models.Group.items.through.objects.bulk_create([
+		models.Group.items.through(group_id=g.pk, item_id=item.pk) for g in groups for item in rng.sample(items, GROUP_SIZE)
+	])
+	models.Group.count_items([g.pk for g in groups])
+
+	# places, with a location so they don't wait on the geocoder, and opening hours
+	places, place_metro = [], {}
+	for i in range(n['places']):
+		metro = metros[i % len(metros)]
+		place = models.Place(
+			name='%s %s' % (PREFIX, _name(rng)), content=_name(rng, 10), public=True, featured=rng.random() < 0.05,
+			address='%d %s St' % (rng.randint(1, 9999), rng.choice(WORDS).title()), city='%s City' % metro.name, state=rng.choice(STATES),
+			location=_near(rng, centers[metro.pk]),
+		)
+		place.save()
+		place_metro[place.pk] = metro.pk
+		places.append(place)
+	models.Place.metro.through.objects.bulk_create([models.Place.metro.through(place_id=p.pk, metro_id=place_metro[p.pk]) for p in places])
+	models.Place.category.through.objects.bulk_create([
+		models.Place.category.through(place_id=p.pk, category_id=c.pk) for p in places for c in rng.sample(categories, rng.randint(1, 2))
+	])
+	models.Item.tags.through.objects.bulk_create([
+		models.Item.tags.through(item_id=p.pk, tag_id=t.pk) for p in places for t in rng.sample(tags, rng.randint(0, 3))
+	])
+	hours = []
+	for p in places:
+		opens = rng.randint(6, 11)
+		closes = rng.choice((17, 18, 21, 23, 1, 2))
+		for weekday in range(1, 8):
+			if rng.random() < 0.9:
+				hours.append(OpeningHours(company_id=p.pk, weekday=weekday, from_hour=datetime.time(opens), to_hour=datetime.time(closes)))
+	OpeningHours.objects.bulk_create(hours)
+	for p in places:
+		p.compile_hours()
+
+	# what organizations show their members
+	tips = models.Tip.objects.bulk_create([models.Tip(name='%s %s' % (PREFIX, _name(rng)), content=_name(rng, 12)) for i in range(n['organizations'] * TIPS_PER_ORGANIZATION)])
+	models.Organization.tips.through.objects.bulk_create([
+		models.Organization.tips.through(organization_id=o.pk, tip_id=t.pk) for o in organizations for t in rng.sample(tips, TIPS_PER_ORGANIZATION)
+	])
+	models.OrgCategory.objects.bulk_create([
+		models.OrgCategory(organization=o, category=c, order=i) for o in organizations for i, c in enumerate(rng.sample(categories, 6))
+	])
+	models.Discover.objects.bulk_create([
+		models.Discover(organization=o, item=item, order=i) for o in organizations for i, item in enumerate(rng.sample(items, 10))
+	])
+	models.Default.objects.bulk_create([
+		models.Default(organization=o, item=item, order=i) for o in organizations for i, item in enumerate(rng.sample(items, 5))
+	])
+
+	# users, each with a list, bookmarks and ratings
+	password = make_password(None)
+	users = User.objects.bulk_create([
+		User(username='%s%d' % (USERNAME_PREFIX, i), email='%s%d@example.com' % (USERNAME_PREFIX, i), password=password) for i in range(n['profiles'])
+	])
+	profiles = []
+	for i, u in enumerate(users):
+		organization = organizations[i % len(organizations)]
+		profiles.append(models.Profile(user=u, organization=organization, location=_near(rng, centers[organization.metro_id])))
+	profiles = models.Profile.objects.bulk_create(profiles)
+	places_by_metro = {}
+	for p in places:
+		places_by_metro.setdefault(place_metro[p.pk], []).append(p)
+	everything = items + groups + places
+	todos, bookmarks, ratings = [], [], []
+	for profile in profiles:
+		metro_id = profile.organization.metro_id
+		nearby = places_by_metro[metro_id]
+		todos += [models.Todo(profile=profile, item=item, order=i, done=rng.random() < 0.3) for i, item in enumerate(rng.sample(items + groups, TODOS_PER_PROFILE))]
+		bookmarks += [models.Bookmark(profile=profile, item=item) for item in rng.sample(everything, BOOKMARKS_PER_PROFILE)]
+		ratings += [models.Rating(profile=profile, place=p, rating=rng.randint(1, 5)) for p in rng.sample(nearby, min(RATINGS_PER_PROFILE, len(nearby)))]
+	models.Todo.objects.bulk_create(todos)
+	models.Bookmark.objects.bulk_create(bookmarks)
+	models.Rating.objects.bulk_create(ratings)
+
+	# bulk inserts skip the signals, so bring every derived table up to date in one go
+	call_command('rebuild_place_ratings', stdout=io.StringIO())
+	for kind in postings.INDEXES:
+		postings.rebuild(kind)
+	for o in organizations:
+		popularity.compact(o)
+	search.index_items([item.pk for item in everything])
+	search.index_tips([t.pk for t in tips])
+	snapshots.rebuild([o.pk for o in organizations])
+	unlocks.invalidate()
+
+	return [
+		('metros', len(metros)), ('organizations', len(organizations)), ('items', len(items)), ('groups', len(groups)),
+		('places', len(places)), ('profiles', len(profiles)), ('todos', len(todos)), ('bookmarks', len(bookmarks)), ('ratings', len(ratings)),
+	]
@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ... import geocoding
+
+
+class Command(BaseCommand):
+	help = "Geocode places waiting on a location, in batches, through the geocode cache. Use --loop to keep running as a worker."
+
+	def add_arguments(self, parser):
+		parser.add_argument('--batch-size', type=int, default=100)
+		parser.add_argument('--loop', action='store_true', help="Keep polling for new places instead of exiting.")
+		parser.add_argument('--interval', type=int, default=30, help="Seconds to wait between polls with --loop.")
+
+	def handle(self, *args, **options):
+		geocoder = geocoding.get_geocoder()
+		while True:
+			processed = geocoding.process_pending(batch_size=options['batch_size'], geocoder=geocoder)
+			if processed:
+				self.stdout.write("Geocoded %d places." % processed)
+			if not options['loop']:
+				return
+			time.sleep(options['interval'])
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from ... import models
+
+
+class Command(BaseCommand):
+	help = "Recompile every Place's opening hours index from OpeningHours and ClosingRules. Run daily to drop expired closing rules."
+
+	def handle(self, *args, **options):
+		count = 0
+		for place in models.Place.objects.only('pk').iterator():
+			place.compile_hours()
+			count += 1
+		self.stdout.write("Compiled opening hours for %d places." % count)
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from ... import models
+
+
+class Command(BaseCommand):
+	help = "Rebuild the is_place / is_group flags on Item and the item_count on every Group."
+
+	def handle(self, *args, **options):
+		with transaction.atomic():
+			places = models.Item.objects.filter(place__isnull=False).update(is_place=True)
+			groups = models.Item.objects.filter(group__isnull=False).update(is_group=True)
+			models.Group.count_items(models.Group.objects.values_list('pk', flat=True))
+		self.stdout.write("Flagged %d places and %d groups." % (places, groups))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from ... import snapshots
+
+
+class Command(BaseCommand):
+	help = "Rebuild the prebuilt discover items, categories and tips of every organization (or just these ones)."
+
+	def add_arguments(self, parser):
+		parser.add_argument('organizations', type=int, nargs='*', help="Organization ids, all of them if none are given.")
+
+	def handle(self, *args, **options):
+		count = snapshots.rebuild(options['organizations'] or None)
+		self.stdout.write("Rebuilt %d organization snapshots." % count)
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.db import models as db_models, transaction
+from django.db.models import Count, Sum, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from ... import models
+
+
+class Command(BaseCommand):
+	help = "Rebuild the denormalized rating count, sum and average on every Place from the Rating table."
+
+	def handle(self, *args, **options):
+		# one set-based UPDATE: each place's aggregates come from a correlated subquery over its ratings
+		ratings = models.Rating.objects.filter(place=OuterRef('pk')).order_by().values('place')
+		count = Subquery(ratings.annotate(c=Count('id')).values('c'), output_field=db_models.IntegerField())
+		total = Subquery(ratings.annotate(s=Sum('rating')).values('s'), output_field=db_models.IntegerField())
+		average = Subquery(ratings.annotate(a=db_models.Avg('rating')).values('a'), output_field=db_models.FloatField())
+		with transaction.atomic():
+			updated = models.Place.objects.update(
+				rating_count=Coalesce(count, 0),
+				rating_sum=Coalesce(total, 0),
+				rating_avg=average,
+			)
+		self.stdout.write("Rebuilt ratings for %d places." % updated)
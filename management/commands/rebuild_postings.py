@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from ... import postings
+
+
+class Command(BaseCommand):
+	help = "Rebuild the tag, category and metro posting lists used by the place filters."
+
+	def handle(self, *args, **options):
+		for kind in postings.INDEXES:
+			postings.rebuild(kind)
+			self.stdout.write("Rebuilt %s posting lists." % kind)
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from ... import models
+from ... import search
+
+
+class Command(BaseCommand):
+	help = "Rebuild the full text search vectors of every item, place, group and tip."
+
+	def add_arguments(self, parser):
+		parser.add_argument('--batch-size', type=int, default=500)
+
+	def handle(self, *args, **options):
+		size = options['batch_size']
+		ids = list(models.Item.objects.order_by('pk').values_list('pk', flat=True))
+		for i in range(0, len(ids), size):
+			search.index_items(ids[i:i + size])
+		search.index_tips(models.Tip.objects.values_list('pk', flat=True))
+		self.stdout.write("Indexed %d items." % len(ids))
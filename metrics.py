@@ -0,0 +1,200 @@
+import time
+import bisect
+import threading
+import contextlib
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+
+from rest_framework import serializers
+
+
+# Per-route and per-SerializerMethodField instrumentation, kept as histograms in this process and served in the
+# Prometheus text format from /metrics. Add 'newto_django.metrics.MetricsMiddleware' to MIDDLEWARE to turn it on.
+
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# X-Query-Profile response header with the request's totals and its most expensive method fields
+DEBUG_HEADER = getattr(settings, 'METRICS_DEBUG_HEADER', settings.DEBUG)
+DEBUG_HEADER_FIELDS = getattr(settings, 'METRICS_DEBUG_HEADER_FIELDS', 5)
+
+# if set, /metrics wants "Authorization: Bearer <token>", otherwise it's only served to signed in staff
+TOKEN = getattr(settings, 'METRICS_TOKEN', None)
+
+
+class Histogram(object):
+
+	def __init__(self, name, help, buckets, labels):
+		self.name = name
+		self.help = help
+		self.buckets = buckets
+		self.labels = labels
+		# label values: [count per bucket..., +Inf count], sum
+		self.series = {}
+		self.lock = threading.Lock()
+
+	def observe(self, value, *labels):
+		with self.lock:
+			counts, total = self.series.get(labels, ([0] * (len(self.buckets) + 1), 0))
+			counts[bisect.bisect_left(self.buckets, value)] += 1
+			self.series[labels] = (counts, total + value)
+
+	def render(self):
+		lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+		with self.lock:
+			series = sorted((labels, list(counts), total) for labels, (counts, total) in self.series.items())
+		for labels, counts, total in series:
+			label = ','.join('%s="%s"' % (k, _escape(v)) for k, v in zip(self.labels, labels))
+			running = 0
+			for bound, count in zip(self.buckets + ('+Inf',), counts):
+				running += count
+				lines.append('%s_bucket{%s%sle="%s"} %d' % (self.name, label, ',' if label else '', bound, running))
+			lines.append('%s_sum{%s} %s' % (self.name, label, repr(float(total))))
+			lines.append('%s_count{%s} %d' % (self.name, label, running))
+		return '\n'.join(lines)
+
+
+def _escape(value):
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REQUEST_QUERIES = Histogram('newto_request_queries', "SQL queries per request.", QUERY_BUCKETS, ('route',))
+REQUEST_DB_SECONDS = Histogram('newto_request_db_seconds', "Time spent in the database per request.", SECONDS_BUCKETS, ('route',))
+REQUEST_SECONDS = Histogram('newto_request_seconds', "Total time per request.", SECONDS_BUCKETS, ('route',))
+REQUEST_SERIALIZE_SECONDS = Histogram('newto_request_serialize_seconds', "Time spent in serializers per request, database time included.", SECONDS_BUCKETS, ('route',))
+RESPONSE_BYTES = Histogram('newto_response_bytes', "Response body size.", BYTES_BUCKETS, ('route',))
+FIELD_QUERIES = Histogram('newto_field_queries', "SQL queries per request made by one SerializerMethodField.", QUERY_BUCKETS, ('route', 'field'))
+FIELD_SECONDS = Histogram('newto_field_seconds', "Time per request spent in one SerializerMethodField.", SECONDS_BUCKETS, ('route', 'field'))
+
+HISTOGRAMS = (REQUEST_QUERIES, REQUEST_DB_SECONDS, REQUEST_SECONDS, REQUEST_SERIALIZE_SECONDS, RESPONSE_BYTES, FIELD_QUERIES, FIELD_SECONDS)
+
+
+class RequestStats(object):
+	# what one request has done so far, filled in by the query wrapper and the serializer mixin
+
+	def __init__(self):
+		self.queries = 0
+		self.db_seconds = 0
+		self.serialize_seconds = 0
+		self.depth = 0
+		# 'Serializer.field': [calls, seconds, queries]
+		self.fields = {}
+
+	def __call__(self, execute, sql, params, many, context):
+		# connection.execute_wrapper hook
+		start = time.perf_counter()
+		try:
+			return execute(sql, params, many, context)
+		finally:
+			self.queries += 1
+			self.db_seconds += time.perf_counter() - start
+
+	def field(self, name, seconds, queries):
+		stats = self.fields.setdefault(name, [0, 0, 0])
+		stats[0] += 1
+		stats[1] += seconds
+		stats[2] += queries
+
+	def header(self):
+		worst = sorted(self.fields.items(), key=lambda f: (f[1][2], f[1][1]), reverse=True)[:DEBUG_HEADER_FIELDS]
+		parts = ['%dq %.1fms' % (self.queries, self.db_seconds * 1000)]
+		parts += ['%s %dq %.1fms x%d' % (name, queries, seconds * 1000, calls) for name, (calls, seconds, queries) in worst]
+		return '; '.join(parts)
+
+
+_local = threading.local()
+
+
+def current():
+	# the stats of the request being handled on this thread, None outside of MetricsMiddleware
+	return getattr(_local, 'stats', None)
+
+
+class MetricsMiddleware(object):
+
+	def __init__(self, get_response):
+		self.get_response = get_response
+
+	def __call__(self, request):
+		stats = RequestStats()
+		_local.stats = stats
+		start = time.perf_counter()
+		try:
+			with contextlib.ExitStack() as stack:
+				for connection in connections.all():
+					stack.enter_context(connection.execute_wrapper(stats))
+				response = self.get_response(request)
+		finally:
+			_local.stats = None
+		elapsed = time.perf_counter() - start
+		match = getattr(request, 'resolver_match', None)
+		route = (match.view_name or match.url_name) if match else 'unmatched'
+		if route == 'metrics':
+			return response
+		REQUEST_QUERIES.observe(stats.queries, route)
+		REQUEST_DB_SECONDS.observe(stats.db_seconds, route)
+		REQUEST_SECONDS.observe(elapsed, route)
+		REQUEST_SERIALIZE_SECONDS.observe(stats.serialize_seconds, route)
+		if not response.streaming:
+			RESPONSE_BYTES.observe(len(response.content), route)
+		for name, (calls, seconds, queries) in stats.fields.items():
+			FIELD_QUERIES.observe(queries, route, name)
+			FIELD_SECONDS.observe(seconds, route, name)
+		if DEBUG_HEADER:
+			response['X-Query-Profile'] = stats.header()
+		return response
+
+
+class TimedMethodField(serializers.SerializerMethodField):
+	# a SerializerMethodField that reports its time and queries to the current request's stats
+
+	def to_representation(self, value):
+		stats = current()
+		if stats is None:
+			return super(TimedMethodField, self).to_representation(value)
+		queries = stats.queries
+		start = time.perf_counter()
+		try:
+			return super(TimedMethodField, self).to_representation(value)
+		finally:
+			stats.field('%s.%s' % (self.parent.__class__.__name__, self.field_name), time.perf_counter() - start, stats.queries - queries)
+
+
+class InstrumentedMixin(object):
+	# Serializer mixin: times serialization, and every SerializerMethodField on the serializer separately.
+	# Nested serializers are counted once, as part of the outermost one, and a method field's numbers include
+	# whatever serializers it runs itself.
+
+	def get_fields(self):
+		fields = super(InstrumentedMixin, self).get_fields()
+		for field in fields.values():
+			if type(field) is serializers.SerializerMethodField:
+				field.__class__ = TimedMethodField
+		return fields
+
+	def to_representation(self, instance):
+		stats = current()
+		if stats is None or stats.depth:
+			return super(InstrumentedMixin, self).to_representation(instance)
+		stats.depth += 1
+		start = time.perf_counter()
+		try:
+			return super(InstrumentedMixin, self).to_representation(instance)
+		finally:
+			stats.depth -= 1
+			stats.serialize_seconds += time.perf_counter() - start
+
+
+def metrics_view(request):
+	if TOKEN:
+		allowed = request.META.get('HTTP_AUTHORIZATION') == 'Bearer %s' % TOKEN
+	else:
+		user = getattr(request, 'user', None)
+		allowed = user is not None and user.is_active and user.is_staff
+	if not allowed:
+		return HttpResponseForbidden()
+	body = '\n'.join(h.render() for h in HISTOGRAMS) + '\n'
+	return HttpResponse(body, content_type='text/plain; version=0.0.4; charset=utf-8')
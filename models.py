@@ -1,11 +1,16 @@
+import bisect
+
 from django.contrib.auth.models import User
 from django.db import models
-from django.db.models.signals import post_save
+from django.db.models.functions import Cast, Coalesce
+from django.db.models.signals import pre_save, post_save, post_delete, pre_delete, m2m_changed
 from django.dispatch import receiver
 from django.contrib.gis.db.models import PointField
-from django.contrib.gis.geos import Point
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
+from django.utils import timezone
 
-from geopy import geocoders
 from localflavor.us.models import USStateField
 from phonenumber_field.modelfields import PhoneNumberField
 
@@ -52,6 +57,7 @@ class Organization(models.Model):
 	categories = models.ManyToManyField('Category', through='OrgCategory', related_name='organization_categories', blank=True, help_text="Categories to show on the search screen.")
 	link = models.URLField(blank=True, help_text="URL for Nav site")
 	location = PointField(blank=True, null=True)
+	updated = models.DateTimeField(auto_now=True, help_text="When this organization was last changed, for ETags.")
 
 	def __str__(self):
 		return self.name
@@ -69,10 +75,14 @@ class Tip(models.Model):
 	name = models.CharField(max_length=128, help_text="Tip headline")
 	content = models.TextField(help_text="Tip text")
 	# keep track of whether seen by user or not?
+	search_vector = SearchVectorField(blank=True, null=True, editable=False)
 	
 	def __str__(self):
 		return self.name
 
+	class Meta:
+		indexes = [GinIndex(fields=['search_vector'])]
+
 
 class Item(models.Model):
 	name = models.CharField(max_length=128, help_text="Title")
@@ -87,13 +97,69 @@ class Item(models.Model):
 	tags = models.ManyToManyField('Tag', blank=True)
 	deadline = models.DateTimeField(blank=True, null=True)
 	video = models.FileField(blank=True) # do we need to post-process this video in any way?
+	is_place = models.BooleanField(default=False, editable=False, help_text="Set for Places, so the type is known without a join.")
+	is_group = models.BooleanField(default=False, editable=False, help_text="Set for Groups, so the type is known without a join.")
+	updated = models.DateTimeField(auto_now=True, help_text="When this item was last changed, for ETags.")
+	search_vector = SearchVectorField(blank=True, null=True, editable=False, help_text="Full text index of name, content, tags and address, see search.py.")
 
 	def __str__(self):
 		return self.name
 
+	class Meta:
+		indexes = [GinIndex(fields=['search_vector'])]
+
+
+@receiver(m2m_changed, sender=Item.tags.through)
+@receiver(m2m_changed, sender=Item.ctas.through)
+def item_relations_changed(sender, instance, action, reverse, pk_set, **kwargs):
+	# the item's tags and ctas are part of its payload, so changing them changes its ETag
+	if action in ('post_add', 'post_remove', 'post_clear'):
+		if not reverse:
+			Item.objects.filter(pk=instance.pk).update(updated=timezone.now())
+		elif pk_set:
+			Item.objects.filter(pk__in=pk_set).update(updated=timezone.now())
+
 
 class Group(Item):
 	items = models.ManyToManyField('Item', related_name='group_items', symmetrical=False, help_text="Items in this group.")
+	item_count = models.IntegerField(default=0, editable=False, help_text="Number of items in this group, kept in step with items.")
+
+	def save(self, *args, **kwargs):
+		self.is_group = True
+		super(Group, self).save(*args, **kwargs)
+
+	@staticmethod
+	def count_items(group_ids):
+		# recount item_count for these groups in one UPDATE
+		counts = Group.items.through.objects.filter(group_id=models.OuterRef('pk')).order_by().values('group_id').annotate(c=models.Count('pk')).values('c')
+		Group.objects.filter(pk__in=group_ids).update(item_count=Coalesce(models.Subquery(counts, output_field=models.IntegerField()), 0), updated=timezone.now())
+
+@receiver(m2m_changed, sender=Group.items.through)
+def group_items_changed(sender, instance, action, reverse, pk_set, **kwargs):
+	if not reverse:
+		# group.items changed
+		if action in ('post_add', 'post_remove', 'post_clear'):
+			Group.count_items([instance.pk])
+	elif action == 'pre_clear':
+		# item.group_items is about to be cleared, remember which groups it was in
+		instance._cleared_groups = list(instance.group_items.values_list('pk', flat=True))
+	elif action in ('post_add', 'post_remove'):
+		Group.count_items(pk_set)
+	elif action == 'post_clear':
+		Group.count_items(getattr(instance, '_cleared_groups', []))
+
+@receiver(pre_delete, sender=Item)
+def item_leaving_groups(sender, instance, **kwargs):
+	# deleting an item cascades away its group memberships without an m2m_changed signal
+	instance._cleared_groups = list(Group.objects.filter(items=instance).values_list('pk', flat=True))
+
+@receiver(post_delete, sender=Item)
+def item_left_groups(sender, instance, **kwargs):
+	Group.count_items(getattr(instance, '_cleared_groups', []))
+
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
 
 
 class Place(Item):
@@ -106,27 +172,135 @@ class Place(Item):
 	featured = models.BooleanField(default=False, help_text="Does this place show up as featured in search results?")
 	category = models.ManyToManyField('Category', blank=True, help_text="Categories that this place appears under in search results.")
 	ratings = models.ManyToManyField('Profile', through='Rating', blank=True)
+	rating_count = models.IntegerField(default=0, editable=False, help_text="Number of ratings, kept in step with Rating.")
+	rating_sum = models.IntegerField(default=0, editable=False, help_text="Sum of all ratings, kept in step with Rating.")
+	rating_avg = models.FloatField(blank=True, null=True, editable=False, help_text="Average rating, kept in step with Rating.")
+	geocode_pending = models.BooleanField(default=False, editable=False, db_index=True, help_text="Waiting for the geocoding worker to find a location.")
+	hours_index = ArrayField(models.IntegerField(), default=list, blank=True, editable=False, help_text="Opening hours as flat, sorted [open, close) minutes of the week.")
+	hours_display = ArrayField(models.CharField(max_length=256), default=list, blank=True, editable=False, help_text="Opening hours text for each weekday, Monday first.")
+	closing_index = ArrayField(models.DateTimeField(), default=list, blank=True, editable=False, help_text="Upcoming closing rules as flat [start, end] pairs.")
 
 	def rating(self):
-		return Rating.objects.filter(place=self).aggregate(models.Avg('rating'))
+		# same shape as the old Rating aggregate, but read from the denormalized columns
+		return {'rating__avg': self.rating_avg}
+
+	def add_to_rating(self, delta_sum, delta_count=0):
+		# adjust the stored aggregates in a single UPDATE, so concurrent raters can't overwrite each other's changes
+		count = models.F('rating_count') + delta_count
+		total = models.F('rating_sum') + delta_sum
+		Place.objects.filter(pk=self.pk).update(
+			updated=timezone.now(),
+			rating_count=count,
+			rating_sum=total,
+			rating_avg=models.Case(
+				models.When(rating_count=-delta_count, then=models.Value(None)),
+				default=models.ExpressionWrapper(Cast(total, models.FloatField()) / count, output_field=models.FloatField()),
+				output_field=models.FloatField(),
+			),
+		)
 	
+	def compile_hours(self):
+		# Compile this place's OpeningHours and ClosingRules into hours_index / hours_display / closing_index,
+		# so checking whether it's open and showing today's hours take no queries. Kept up to date by the receivers below.
+		intervals = []
+		display = [''] * 7
+		for o in self.openinghours_set.order_by('weekday', 'from_hour'):
+			day = (o.weekday - 1) * MINUTES_PER_DAY
+			start = day + o.from_hour.hour * 60 + o.from_hour.minute
+			end = day + o.to_hour.hour * 60 + o.to_hour.minute
+			if o.to_hour < o.from_hour:
+				# open past midnight, Sunday night wraps around to Monday morning
+				end += MINUTES_PER_DAY
+			if end > MINUTES_PER_WEEK:
+				intervals += [[start, MINUTES_PER_WEEK], [0, end - MINUTES_PER_WEEK]]
+			else:
+				intervals.append([start, end])
+			display[o.weekday - 1] += '%s%s to %s%s ' % (
+				o.from_hour.strftime('%I:%M').lstrip('0'),
+				o.from_hour.strftime('%p').lower(),
+				o.to_hour.strftime('%I:%M').lstrip('0'),
+				o.to_hour.strftime('%p').lower()
+			)
+		merged = []
+		for start, end in sorted(intervals):
+			if merged and start <= merged[-1][1]:
+				merged[-1][1] = max(merged[-1][1], end)
+			else:
+				merged.append([start, end])
+		self.hours_index = [minute for interval in merged for minute in interval]
+		self.hours_display = display
+		self.closing_index = [when for rule in self.closingrules_set.filter(end__gte=timezone.now()).order_by('start') for when in (rule.start, rule.end)]
+		Place.objects.filter(pk=self.pk).update(hours_index=self.hours_index, hours_display=self.hours_display, closing_index=self.closing_index, updated=timezone.now())
+
+	@staticmethod
+	def hours_open(hours_index, closing_index, now):
+		# open if no closing rule covers now, and now falls inside one of the [open, close) intervals,
+		# which in the flat sorted array means an odd number of boundaries at or before it
+		for i in range(0, len(closing_index), 2):
+			start, end = closing_index[i], closing_index[i + 1]
+			if timezone.is_aware(start) and timezone.is_naive(now):
+				now = timezone.make_aware(now)
+			if start <= now <= end:
+				return False
+		minute = (now.isoweekday() - 1) * MINUTES_PER_DAY + now.hour * 60 + now.minute
+		return bisect.bisect_right(hours_index, minute) % 2 == 1
+
+	def is_open(self, now):
+		return Place.hours_open(self.hours_index, self.closing_index, now)
+
+	def hours_today(self, now):
+		if not self.hours_display:
+			return ''
+		return self.hours_display[now.isoweekday() - 1]
+
+	def full_address(self):
+		return self.address + ", " + self.city + ", " + self.state
+
 	def save(self, *args, **kwargs):
-		if self.address:
-			fulladdress = self.address + ", " + self.city + ", " + self.state
-			if not self.location:
-				try:
-					g = geocoders.GoogleV3()
-					l = g.geocode(fulladdress)
-					self.location = Point(l.latitude, l.longitude)
-				except:
-					print("geocoding error")
+		self.is_place = True
+		# geocoding happens in the background (see geocoding.py and the geocode_places command),
+		# here we only use an address we've already geocoded, or queue the place up for the worker
+		if self.location or not self.address:
+			self.geocode_pending = False
+		else:
+			cached = GeocodeCache.objects.filter(address=GeocodeCache.normalize(self.full_address())).first()
+			if cached:
+				self.location = cached.location
+				self.geocode_pending = False
+			else:
+				self.geocode_pending = True
 		super(Place, self).save(*args, **kwargs)
 
 
+@receiver(post_save, sender='openinghours.OpeningHours')
+@receiver(post_delete, sender='openinghours.OpeningHours')
+@receiver(post_save, sender='openinghours.ClosingRules')
+@receiver(post_delete, sender='openinghours.ClosingRules')
+def compile_place_hours(sender, instance, **kwargs):
+	Place(pk=instance.company_id).compile_hours()
+
+
+class GeocodeCache(models.Model):
+	# every address we've asked the geocoder about, so the same address is never geocoded twice
+	address = models.CharField(max_length=512, unique=True, help_text="Normalized full address.")
+	location = PointField(blank=True, null=True, help_text="Empty if the geocoder couldn't find the address.")
+	created = models.DateTimeField(auto_now_add=True)
+
+	def __str__(self):
+		return self.address
+
+	@staticmethod
+	def normalize(address):
+		# lowercase, collapse whitespace and tidy commas, so trivially different spellings share a cache entry
+		parts = [" ".join(part.split()) for part in address.lower().split(",")]
+		return ", ".join(part for part in parts if part)
+
+
 class Category(models.Model):
 	name = models.CharField(max_length=128, unique=True)
 	image = models.ImageField(blank=True)
 	tags = models.ManyToManyField('Tag', blank=True, help_text="Tags that we offer the user when searching within this Category.")
+	updated = models.DateTimeField(auto_now=True, help_text="When this category was last changed, for the /api/me/ ETag.")
 
 	def __str__(self):
 		return self.name
@@ -150,18 +324,67 @@ class Cta(models.Model):
 		return self.name
 
 
+# the Item m2m field each of these is shown through
+ITEM_RELATIONS = {Tag: 'tags', Cta: 'ctas'}
+
+@receiver(post_save, sender=Tag)
+@receiver(post_save, sender=Cta)
+def item_relation_saved(sender, instance, created, raw=False, **kwargs):
+	# a renamed tag or an edited cta changes the payload, and so the ETag, of every item carrying it
+	if not created and not raw:
+		Item.objects.filter(**{ITEM_RELATIONS[sender]: instance}).update(updated=timezone.now())
+
+@receiver(pre_delete, sender=Tag)
+@receiver(pre_delete, sender=Cta)
+def item_relation_deleting(sender, instance, **kwargs):
+	# the m2m rows go with it, without an m2m_changed signal
+	instance._etag_item_ids = list(Item.objects.filter(**{ITEM_RELATIONS[sender]: instance}).values_list('pk', flat=True))
+
+@receiver(post_delete, sender=Tag)
+@receiver(post_delete, sender=Cta)
+def item_relation_deleted(sender, instance, **kwargs):
+	Item.objects.filter(pk__in=getattr(instance, '_etag_item_ids', [])).update(updated=timezone.now())
+
+
 class Rating(models.Model):
 	profile = models.ForeignKey('Profile', on_delete=models.CASCADE)
 	place = models.ForeignKey('Place', on_delete=models.CASCADE)
 	rating = models.IntegerField(help_text="Number of stars from 1-5.")
 	# need to add unique constraints to prevent multiple ratings from the same user?
 
+@receiver(pre_save, sender=Rating)
+def remember_place_rating(sender, instance, raw=False, **kwargs):
+	# what an edited rating (like one changed in the admin) counted for before, so only the difference is applied
+	instance._previous_rating = None
+	if instance.pk and not raw:
+		instance._previous_rating = Rating.objects.filter(pk=instance.pk).values_list('place_id', 'rating').first()
+
+@receiver(post_save, sender=Rating)
+def add_place_rating(sender, instance, raw=False, **kwargs):
+	# saved ratings, from the API or the admin, go into the place's aggregates
+	if raw:
+		return
+	previous = getattr(instance, '_previous_rating', None)
+	if previous is None:
+		Place(pk=instance.place_id).add_to_rating(instance.rating, 1)
+	elif previous[0] != instance.place_id:
+		Place(pk=previous[0]).add_to_rating(-previous[1], -1)
+		Place(pk=instance.place_id).add_to_rating(instance.rating, 1)
+	elif previous[1] != instance.rating:
+		Place(pk=instance.place_id).add_to_rating(instance.rating - previous[1])
+
+@receiver(post_delete, sender=Rating)
+def remove_place_rating(sender, instance, **kwargs):
+	# deleted ratings (including cascades from a deleted profile) come back out of the place's aggregates
+	Place(pk=instance.place_id).add_to_rating(-instance.rating, -1)
+
 
 class Todo(models.Model):
 	profile = models.ForeignKey('Profile', related_name='todo_profile', on_delete=models.CASCADE)
 	item = models.ForeignKey('Item', related_name='todo_item', on_delete=models.CASCADE)
 	order = models.IntegerField() # required?
 	done = models.BooleanField(default=False)
+	added = models.DateTimeField(auto_now_add=True, blank=True, null=True, help_text="When this item was added to the user's list.")
 	# need to add unique constraints to prevent duplicate todo items?
 	
 	class Meta:
@@ -209,3 +432,59 @@ class OrgCategory(models.Model):
 		verbose_name = "category"
 		ordering = ('order',)
 
+
+class Popularity(models.Model):
+	# Materialized leaderboard behind OrganizationSerializer.get_popular.
+	# Rows with an organization score items todo'd and bookmarked by that organization's members,
+	# rows with a metro score places bookmarked in that metro. See popularity.py for how scores decay.
+	organization = models.ForeignKey('Organization', related_name='popularity_organization', on_delete=models.CASCADE, blank=True, null=True)
+	metro = models.ForeignKey('Metro', related_name='popularity_metro', on_delete=models.CASCADE, blank=True, null=True)
+	item = models.ForeignKey('Item', related_name='popularity_item', on_delete=models.CASCADE)
+	score = models.FloatField(default=0)
+
+	class Meta:
+		verbose_name_plural = "popularity"
+		unique_together = (('organization', 'item'), ('metro', 'item'))
+		indexes = [
+			models.Index(fields=['organization', '-score']),
+			models.Index(fields=['metro', '-score']),
+		]
+
+
+class PostingList(models.Model):
+	# Sorted ids of the items tagged with a Tag, or the places in a Category or Metro, so multi-tag AND filters
+	# read one row per tag instead of joining the m2m tables once per tag. See postings.py.
+	kind = models.CharField(max_length=16, choices=(('tag', 'Tag'), ('category', 'Category'), ('metro', 'Metro')))
+	key = models.IntegerField(help_text="Id of the Tag, Category or Metro.")
+	ids = ArrayField(models.IntegerField(), default=list, blank=True)
+
+	class Meta:
+		unique_together = (('kind', 'key'),)
+
+
+class PlaceCluster(models.Model):
+	# Map clusters: public places in a metro (and optionally one category), counted per grid cell for each zoom level,
+	# so the map gets a handful of rows per screen instead of every place. Built by the build_place_clusters command, see clusters.py.
+	metro = models.ForeignKey('Metro', related_name='cluster_metro', on_delete=models.CASCADE)
+	category = models.ForeignKey('Category', related_name='cluster_category', on_delete=models.CASCADE, blank=True, null=True, help_text="Empty for all categories.")
+	zoom = models.IntegerField()
+	cell_x = models.IntegerField()
+	cell_y = models.IntegerField()
+	count = models.IntegerField()
+	latitude = models.FloatField(help_text="Centroid of the places in the cell.")
+	longitude = models.FloatField()
+	place = models.ForeignKey('Place', related_name='cluster_place', on_delete=models.CASCADE, help_text="The place shown for the cell.")
+
+	class Meta:
+		indexes = [
+			models.Index(fields=['metro', 'category', 'zoom', 'cell_x', 'cell_y']),
+		]
+
+
+class OrganizationSnapshot(models.Model):
+	# The parts of an organization's payload that only staff change (discover items, categories and tips), serialized ahead of time,
+	# so /api/me/ reads one row instead of re-serializing them. Rebuilt whenever what they're made of changes, see snapshots.py.
+	organization = models.OneToOneField('Organization', related_name='snapshot', on_delete=models.CASCADE)
+	# the encoded JSON text rather than jsonb, which would lose the serializers' key order
+	data = models.TextField(default='{}')
+	built = models.DateTimeField(auto_now=True)
@@ -0,0 +1,17 @@
+from rest_framework.pagination import CursorPagination
+
+
+class KeysetPagination(CursorPagination):
+	# Cursor pagination keyed on id, or on distance when ?near= is sorting places nearest first.
+	# Every page is a "WHERE key > cursor ORDER BY key LIMIT n", so deep pages cost the same as the first one,
+	# with no COUNT(*) and no OFFSET scan. The next and previous links carry opaque cursors.
+	page_size = 50
+	page_size_query_param = 'page_size'
+	max_page_size = 200
+	ordering = 'id'
+
+	def get_ordering(self, request, queryset, view):
+		# NearFilter orders by the great circle distance PlaceFilter annotates, the one the client sees, with id breaking ties
+		if 'distance' in queryset.query.annotations and tuple(queryset.query.order_by[:1]) == ('distance',):
+			return ('distance', 'id')
+		return (self.ordering,)
@@ -0,0 +1,161 @@
+import math
+import datetime
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from . import models
+
+
+# How long it takes a todo or bookmark to lose half of its weight in the popularity rankings
+HALF_LIFE_DAYS = getattr(settings, 'POPULAR_HALF_LIFE_DAYS', 30)
+DECAY = math.log(2) / (HALF_LIFE_DAYS * 24 * 60 * 60)
+
+# Scores use "forward decay": instead of shrinking every stored score as time passes, each event is stored with a weight
+# that grows with its time, exp(DECAY * (t - EPOCH)). Ranking by the stored score is the same as ranking by the decayed score
+# at any moment, so an event is a single += on one row and a read is a plain indexed ORDER BY score DESC.
+# The weights double every half-life, which a float can hold for decades before overflowing.
+EPOCH = datetime.datetime(2018, 1, 1, tzinfo=timezone.utc)
+
+TODO_WEIGHT = 1
+BOOKMARK_WEIGHT = 1
+# places only get bookmarked, so weigh them double to keep them in line with items
+PLACE_BOOKMARK_WEIGHT = 2
+
+# compaction drops rows whose current decayed score has fallen below this
+MIN_SCORE = getattr(settings, 'POPULAR_MIN_SCORE', 0.01)
+
+
+def _seconds(when):
+	if when is None:
+		when = timezone.now()
+	if timezone.is_naive(when):
+		when = timezone.make_aware(when)
+	return (when - EPOCH).total_seconds()
+
+
+def weight(when=None):
+	# stored weight of an event that happened at 'when'
+	return math.exp(DECAY * _seconds(when))
+
+
+def current(score):
+	# turn a stored score into its decayed value as of now
+	return score * math.exp(-DECAY * _seconds(None))
+
+
+def _add(item_ids, delta, organization_id=None, metro_id=None):
+	# add delta to each item's row on one leaderboard: one UPDATE for rows that exist, one bulk INSERT for the rest
+	item_ids = set(item_ids)
+	if not item_ids or not delta or (organization_id is None and metro_id is None):
+		return
+	rows = models.Popularity.objects.filter(organization_id=organization_id, metro_id=metro_id, item_id__in=item_ids)
+	if delta < 0:
+		# removals can't take a row below zero, compaction sorts out any drift
+		rows.update(score=Greatest(F('score') + delta, 0))
+		return
+	existing = set(rows.values_list('item_id', flat=True))
+	rows.update(score=F('score') + delta)
+	missing = item_ids - existing
+	if missing:
+		try:
+			with transaction.atomic():
+				models.Popularity.objects.bulk_create([
+					models.Popularity(organization_id=organization_id, metro_id=metro_id, item_id=i, score=delta) for i in missing
+				])
+		except IntegrityError:
+			# someone else inserted one of these rows in the meantime, fall back to updating them
+			models.Popularity.objects.filter(organization_id=organization_id, metro_id=metro_id, item_id__in=missing).update(score=F('score') + delta)
+
+
+def _place_metros(item_ids):
+	# metro ids for each of these items that is a place, as {metro_id: set(item_ids)}
+	metros = {}
+	for place_id, metro_id in models.Place.metro.through.objects.filter(place_id__in=item_ids).values_list('place_id', 'metro_id'):
+		metros.setdefault(metro_id, set()).add(place_id)
+	return metros
+
+
+def todos_added(profile, item_ids, when=None):
+	organization_todos_added(profile.organization_id, item_ids, when=when)
+
+
+def organization_todos_added(organization_id, item_ids, count=1, when=None):
+	# count is how many members of the organization each item was added for, so cohorts cost one write per item
+	_add(item_ids, count * TODO_WEIGHT * weight(when), organization_id=organization_id)
+
+
+def todos_removed(profile, todos):
+	organization_todos_removed(profile.organization_id, todos)
+
+
+def organization_todos_removed(organization_id, todos):
+	# todos is a list of (item_id, added) pairs, so each one comes back out with the weight it went in with.
+	# The weights are summed per item first, so a whole list (or a cohort's lists) costs one write per item.
+	deltas = {}
+	for item_id, added in todos:
+		deltas[item_id] = deltas.get(item_id, 0) - TODO_WEIGHT * weight(added or EPOCH)
+	for item_id, delta in deltas.items():
+		_add([item_id], delta, organization_id=organization_id)
+
+
+def bookmark_added(profile, item_id, previous=None):
+	# previous is the datetime of the bookmark being refreshed, if there was one, so a re-bookmark only moves it forward in time
+	delta = weight() - (weight(previous) if previous else 0)
+	_add([item_id], BOOKMARK_WEIGHT * delta, organization_id=profile.organization_id)
+	for metro_id, place_ids in _place_metros([item_id]).items():
+		_add(place_ids, PLACE_BOOKMARK_WEIGHT * delta, metro_id=metro_id)
+
+
+def bookmark_removed(profile, item_id, when):
+	delta = -weight(when)
+	_add([item_id], BOOKMARK_WEIGHT * delta, organization_id=profile.organization_id)
+	for metro_id, place_ids in _place_metros([item_id]).items():
+		_add(place_ids, PLACE_BOOKMARK_WEIGHT * delta, metro_id=metro_id)
+
+
+def top(organization, items=20, places=10):
+	# the public items most popular with this organization, and the public places most popular in its metro, as [(item_id, score)],
+	# each one an index read of the top rows, merged and sorted by their current decayed score
+	popular = list(models.Popularity.objects.filter(organization=organization, item__public=True).order_by('-score').values_list('item_id', 'score')[:items])
+	popular += list(models.Popularity.objects.filter(metro=organization.metro_id, item__public=True).order_by('-score').values_list('item_id', 'score')[:places])
+	scale = current(1)
+	return [(item_id, round(score * scale, 2)) for item_id, score in sorted(popular, key=lambda p: p[1], reverse=True)]
+
+
+def compact(organization=None):
+	# rebuild the leaderboards from Todo and Bookmark, dropping rows that have decayed away.
+	# Meant to be run periodically (see the compact_popularity command) to correct any drift from the incremental updates.
+	organizations = models.Organization.objects.all()
+	if organization is not None:
+		organizations = organizations.filter(pk=organization.pk)
+	for org in organizations:
+		scores = {}
+		for item_id, added in models.Todo.objects.filter(profile__organization=org).values_list('item_id', 'added').iterator():
+			scores[item_id] = scores.get(item_id, 0) + TODO_WEIGHT * weight(added or EPOCH)
+		for item_id, when in models.Bookmark.objects.filter(profile__organization=org).values_list('item_id', 'datetime').iterator():
+			scores[item_id] = scores.get(item_id, 0) + BOOKMARK_WEIGHT * weight(when)
+		_replace(scores, organization_id=org.pk)
+	if organization is None:
+		metros = models.Metro.objects.all()
+	else:
+		metros = models.Metro.objects.filter(pk=organization.metro_id)
+	for metro in metros:
+		scores = {}
+		bookmarks = models.Bookmark.objects.filter(item__place__metro=metro).values_list('item_id', 'datetime')
+		for item_id, when in bookmarks.iterator():
+			scores[item_id] = scores.get(item_id, 0) + PLACE_BOOKMARK_WEIGHT * weight(when)
+		_replace(scores, metro_id=metro.pk)
+
+
+def _replace(scores, organization_id=None, metro_id=None):
+	scale = current(1)
+	with transaction.atomic():
+		models.Popularity.objects.filter(organization_id=organization_id, metro_id=metro_id).delete()
+		models.Popularity.objects.bulk_create([
+			models.Popularity(organization_id=organization_id, metro_id=metro_id, item_id=item_id, score=score)
+			for item_id, score in scores.items() if score * scale >= MIN_SCORE
+		])
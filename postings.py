@@ -0,0 +1,120 @@
+from django.db import connection, transaction
+from django.db.models.expressions import RawSQL
+from django.db.models.signals import m2m_changed, pre_delete, post_delete
+
+from . import models
+
+
+# kind: (m2m through table, column holding the key, column holding the item id)
+INDEXES = {
+	'tag': (models.Item.tags.through, 'tag_id', 'item_id'),
+	'category': (models.Place.category.through, 'category_id', 'place_id'),
+	'metro': (models.Place.metro.through, 'metro_id', 'place_id'),
+}
+
+
+def rebuild(kind, keys=None):
+	# rewrite the posting lists for these keys (or all of them) from the m2m table, in one read; for the rebuild_postings command
+	through, key_field, id_field = INDEXES[kind]
+	rows = through.objects.all()
+	lists = models.PostingList.objects.filter(kind=kind)
+	if keys is not None:
+		keys = set(keys)
+		if not keys:
+			return
+		rows = rows.filter(**{key_field + '__in': keys})
+		lists = lists.filter(key__in=keys)
+	ids = {}
+	for key, item_id in rows.order_by(id_field).values_list(key_field, id_field):
+		ids.setdefault(key, []).append(item_id)
+	with transaction.atomic():
+		lists.delete()
+		models.PostingList.objects.bulk_create([models.PostingList(kind=kind, key=key, ids=item_ids) for key, item_ids in ids.items()])
+
+
+def add(kind, keys, ids):
+	# put these ids on these keys' lists, in place, in one statement
+	keys, ids = list(keys), sorted(ids)
+	if not keys or not ids:
+		return
+	table = models.PostingList._meta.db_table
+	with connection.cursor() as cursor:
+		cursor.execute(
+			'INSERT INTO {0} (kind, key, ids) SELECT %s, k, %s::integer[] FROM unnest(%s::integer[]) AS k '
+			'ON CONFLICT (kind, key) DO UPDATE SET ids = ARRAY(SELECT DISTINCT i FROM unnest({0}.ids || EXCLUDED.ids) AS i ORDER BY i)'.format(table),
+			(kind, ids, keys))
+
+
+def remove(kind, keys, ids):
+	# take these ids off these keys' lists, in place, in one statement
+	keys, ids = list(keys), list(ids)
+	if not keys or not ids:
+		return
+	table = models.PostingList._meta.db_table
+	with connection.cursor() as cursor:
+		cursor.execute(
+			'UPDATE {0} SET ids = ARRAY(SELECT i FROM unnest(ids) AS i WHERE i <> ALL(%s::integer[]) ORDER BY i) '
+			'WHERE kind = %s AND key = ANY(%s::integer[])'.format(table),
+			(ids, kind, keys))
+
+
+def _members(kind, keys):
+	# the ids on any of these posting lists, as a subquery
+	sql = 'SELECT unnest(ids) FROM %s WHERE kind = %%s AND key = ANY(%%s)' % models.PostingList._meta.db_table
+	return RawSQL(sql, (kind, list(keys)))
+
+
+def restrict(queryset, tags=(), categories=(), metros=()):
+	# Keeps the rows on every one of the tags' lists, any of the categories' and any of the metros'.
+	# Each is an IN over the unnested array, so the database intersects them and the ids never come through Python.
+	for tag in tags:
+		queryset = queryset.filter(pk__in=_members('tag', [tag]))
+	if categories:
+		queryset = queryset.filter(pk__in=_members('category', categories))
+	if metros:
+		queryset = queryset.filter(pk__in=_members('metro', metros))
+	return queryset
+
+
+def _connect(kind):
+	through, key_field, id_field = INDEXES[kind]
+	attr = '_posting_keys_%s' % kind
+
+	def keys_of(instance):
+		return list(through.objects.filter(**{id_field: instance.pk}).values_list(key_field, flat=True))
+
+	def changed(sender, instance, action, reverse, pk_set, **kwargs):
+		# only the ids that changed are added or removed, the rest of the lists are left alone
+		if reverse:
+			# the tag / category / metro's own set of items changed
+			if action == 'post_add':
+				add(kind, [instance.pk], pk_set)
+			elif action == 'post_remove':
+				remove(kind, [instance.pk], pk_set)
+			elif action == 'post_clear':
+				# nothing's left on the list, so this reads no rows
+				rebuild(kind, [instance.pk])
+		elif action == 'pre_clear':
+			setattr(instance, attr, keys_of(instance))
+		elif action == 'post_clear':
+			remove(kind, getattr(instance, attr, []), [instance.pk])
+		elif action == 'post_add':
+			add(kind, pk_set, [instance.pk])
+		elif action == 'post_remove':
+			remove(kind, pk_set, [instance.pk])
+
+	def deleting(sender, instance, **kwargs):
+		# deleting an item cascades away its m2m rows without an m2m_changed signal
+		setattr(instance, attr, keys_of(instance))
+
+	def deleted(sender, instance, **kwargs):
+		remove(kind, getattr(instance, attr, []), [instance.pk])
+
+	model = models.Item if kind == 'tag' else models.Place
+	m2m_changed.connect(changed, sender=through, weak=False, dispatch_uid='postings_changed_%s' % kind)
+	pre_delete.connect(deleting, sender=model, weak=False, dispatch_uid='postings_deleting_%s' % kind)
+	post_delete.connect(deleted, sender=model, weak=False, dispatch_uid='postings_deleted_%s' % kind)
+
+
+for kind in INDEXES:
+	_connect(kind)
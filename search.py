@@ -0,0 +1,125 @@
+import re
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchQueryField, SearchRank, SearchVector
+from django.db.models import F, Func, Q, TextField, Value
+from django.db.models.signals import m2m_changed, post_save, pre_delete, post_delete
+from django.dispatch import receiver
+
+from . import models
+
+
+# text search configuration used for both the stored vectors and the queries
+CONFIG = getattr(settings, 'SEARCH_CONFIG', 'english')
+
+# how many words of a query are used, anything after that is ignored
+MAX_WORDS = 8
+
+
+class PrefixQuery(Func):
+	# to_tsquery('english', 'coff:* & sho:*'), so every word of the query also matches as a prefix, for autocomplete
+	function = 'to_tsquery'
+	output_field = SearchQueryField()
+
+
+def _vector(*parts):
+	# a tsvector built from (text, weight) pairs, computed from values we already have in hand instead of joins
+	vector = None
+	for text, weight in parts:
+		part = SearchVector(Value(text or '', output_field=TextField()), weight=weight, config=CONFIG)
+		vector = part if vector is None else vector + part
+	return vector
+
+
+def index_items(ids):
+	# rewrite the search vectors of these items: name weighs most, then tags and address, then the description
+	ids = set(ids)
+	if not ids:
+		return
+	items = models.Item.objects.filter(pk__in=ids).select_related('place').prefetch_related('tags')
+	for item in items:
+		address = ''
+		if item.is_place:
+			address = ' '.join([item.place.address, item.place.city, item.place.state or ''])
+		tags = ' '.join(tag.name for tag in item.tags.all())
+		vector = _vector((item.name, 'A'), (tags, 'B'), (address, 'B'), (item.content, 'C'))
+		models.Item.objects.filter(pk=item.pk).update(search_vector=vector)
+
+
+def index_tips(ids):
+	ids = set(ids)
+	if not ids:
+		return
+	for tip in models.Tip.objects.filter(pk__in=ids):
+		models.Tip.objects.filter(pk=tip.pk).update(search_vector=_vector((tip.name, 'A'), (tip.content, 'B')))
+
+
+def query(text):
+	# None if there's nothing searchable in the text
+	words = re.findall(r'\w+', text or '', re.UNICODE)[:MAX_WORDS]
+	if not words:
+		return None
+	return PrefixQuery(Value(CONFIG), Value(' & '.join('%s:*' % word for word in words)))
+
+
+def items(organization, q, limit=20):
+	# public items, and public places in the organization's metro, matching q, best match first.
+	# The match is answered by the GIN index on search_vector, ranking only looks at the rows that matched.
+	scope = Q(is_place=False)
+	if organization is not None:
+		scope |= Q(place__metro=organization.metro_id)
+	else:
+		scope |= Q(is_place=True)
+	return models.Item.objects.filter(scope, public=True, search_vector=q).annotate(rank=SearchRank(F('search_vector'), q)).order_by('-rank', 'id').select_related('place', 'group')[:limit]
+
+
+def tips(organization, q, limit=20):
+	if organization is None:
+		return models.Tip.objects.none()
+	return organization.tips.filter(search_vector=q).annotate(rank=SearchRank(F('search_vector'), q)).order_by('-rank', 'id')[:limit]
+
+
+def item_saved(sender, instance, raw=False, **kwargs):
+	if not raw:
+		index_items([instance.pk])
+
+
+def tip_saved(sender, instance, raw=False, **kwargs):
+	if not raw:
+		index_tips([instance.pk])
+
+
+# Places and Groups are saved as their own models, so each gets its own connection
+for model in (models.Item, models.Place, models.Group):
+	post_save.connect(item_saved, sender=model, dispatch_uid='search_item_saved_%s' % model._meta.model_name)
+post_save.connect(tip_saved, sender=models.Tip, dispatch_uid='search_tip_saved')
+
+
+@receiver(m2m_changed, sender=models.Item.tags.through)
+def item_tags_changed(sender, instance, action, reverse, pk_set, **kwargs):
+	if not reverse:
+		if action in ('post_add', 'post_remove', 'post_clear'):
+			index_items([instance.pk])
+	elif action == 'pre_clear':
+		instance._search_item_ids = list(instance.item_set.values_list('pk', flat=True))
+	elif action == 'post_clear':
+		index_items(getattr(instance, '_search_item_ids', []))
+	elif action in ('post_add', 'post_remove'):
+		index_items(pk_set)
+
+
+@receiver(post_save, sender=models.Tag)
+def tag_saved(sender, instance, created, raw=False, **kwargs):
+	# a renamed tag changes the vectors of every item carrying it
+	if not created and not raw:
+		index_items(instance.item_set.values_list('pk', flat=True))
+
+
+@receiver(pre_delete, sender=models.Tag)
+def tag_deleting(sender, instance, **kwargs):
+	instance._search_item_ids = list(instance.item_set.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=models.Tag)
+def tag_deleted(sender, instance, **kwargs):
+	index_items(getattr(instance, '_search_item_ids', []))
@@ -0,0 +1,187 @@
+import json
+import threading
+
+from django.db import IntegrityError, transaction
+from django.db.models.signals import m2m_changed, post_save, pre_delete, post_delete
+from django.dispatch import receiver
+
+from rest_framework.utils import encoders
+
+from . import caching
+from . import models
+from . import viewer
+
+
+# Per-organization snapshots of the discover items, categories and tips, as the JSON they go out as.
+# The discover cards are stored with blank viewer flags (and the item ids beside them), OrganizationSerializer lays
+# the viewer's flags over them. Staff change these lists in OrganizationAdmin, and every change to them, or to the
+# items, categories and tags they show, rebuilds the snapshots involved once the change is committed.
+
+_local = threading.local()
+
+
+def build(organization):
+	# the snapshot as JSON text; api imports this module for its serializers
+	from . import api
+	rows = api.DISCOVER_CARDS.rows(models.Discover.objects.filter(organization=organization))
+	categories = models.OrgCategory.objects.filter(organization=organization).select_related('category').prefetch_related('category__tags')
+	data = {
+		'discover_ids': [row[api.DISCOVER_CARDS.id_column] for row in rows],
+		'discover_items': api.DISCOVER_CARDS.render(rows, None, viewer=viewer.ViewerState()),
+		'categories': [api.CategorySerializer(m).data for m in categories],
+		'tips': api.TipSerializer(organization.tips.all(), many=True).data,
+	}
+	# through the renderer's encoder, so dates and such read back exactly as they'd have been sent
+	return json.dumps(data, cls=encoders.JSONEncoder)
+
+
+def get(organization):
+	# the organization's snapshot, built and stored the first time it's asked for, decoded with its key order intact
+	try:
+		return json.loads(organization.snapshot.data)
+	except models.OrganizationSnapshot.DoesNotExist:
+		pass
+	data = build(organization)
+	try:
+		with transaction.atomic():
+			models.OrganizationSnapshot.objects.create(organization=organization, data=data)
+	except IntegrityError:
+		# built by someone else meanwhile; theirs wins, in case a rebuild already replaced it
+		pass
+	return json.loads(data)
+
+
+def rebuild(organization_ids=None):
+	# rebuild the snapshots of these organizations (or all of them), returns how many were rebuilt
+	organizations = models.Organization.objects.all()
+	if organization_ids is not None:
+		organizations = organizations.filter(pk__in=organization_ids)
+	count = 0
+	for organization in organizations:
+		models.OrganizationSnapshot.objects.update_or_create(organization=organization, defaults={'data': build(organization)})
+		caching.bump_organization(organization.pk)
+		count += 1
+	return count
+
+
+def invalidate(organization_ids):
+	# Rebuilds these organizations' snapshots once the current transaction commits, so they're built from what was saved.
+	# An admin save with a dozen inline rows fires a dozen of these, the first commit hook rebuilds everything pending.
+	ids = set(pk for pk in organization_ids if pk is not None)
+	if not ids:
+		return
+	_local.pending = getattr(_local, 'pending', set()) | ids
+	transaction.on_commit(_rebuild_pending)
+
+
+def _rebuild_pending():
+	ids = getattr(_local, 'pending', set())
+	_local.pending = set()
+	if ids:
+		rebuild(ids)
+
+
+# the organizations whose snapshot shows these items, categories, tags or tips
+
+def _discovering(item_ids):
+	return list(models.Discover.objects.filter(item__in=item_ids).values_list('organization_id', flat=True).distinct())
+
+
+def _showing(category_ids):
+	return list(models.OrgCategory.objects.filter(category__in=category_ids).values_list('organization_id', flat=True).distinct())
+
+
+def _tagged(tag_ids):
+	items = models.Item.tags.through.objects.filter(tag__in=tag_ids).values('item_id')
+	categories = models.Category.tags.through.objects.filter(tag__in=tag_ids).values('category_id')
+	return _discovering(items) + _showing(categories)
+
+
+def _tipping(tip_ids):
+	return list(models.Organization.tips.through.objects.filter(tip__in=tip_ids).values_list('organization_id', flat=True).distinct())
+
+
+def _connect_m2m(through, owner_field, other_field, organizations):
+	# organizations(ids) gives the organizations showing the owners (the side the m2m field is declared on) with these ids
+
+	def affected(instance, reverse, pk_set):
+		if not reverse:
+			return organizations([instance.pk])
+		if pk_set is None:
+			# cleared from the other side, everything it was linked to
+			pk_set = through.objects.filter(**{other_field: instance.pk}).values_list(owner_field, flat=True)
+		return organizations(pk_set)
+
+	def changed(sender, instance, action, reverse, pk_set, **kwargs):
+		if action == 'pre_clear':
+			instance._snapshot_organizations = affected(instance, reverse, None)
+		elif action == 'post_clear':
+			invalidate(getattr(instance, '_snapshot_organizations', []))
+		elif action in ('post_add', 'post_remove'):
+			invalidate(affected(instance, reverse, pk_set))
+
+	m2m_changed.connect(changed, sender=through, weak=False, dispatch_uid='snapshots_%s' % through._meta.db_table)
+
+
+_connect_m2m(models.Item.tags.through, 'item_id', 'tag_id', _discovering)
+_connect_m2m(models.Category.tags.through, 'category_id', 'tag_id', _showing)
+_connect_m2m(models.Organization.tips.through, 'organization_id', 'tip_id', lambda ids: list(ids))
+# a group's item count is on its card
+_connect_m2m(models.Group.items.through, 'group_id', 'item_id', _discovering)
+
+
+@receiver(post_save, sender=models.Discover)
+@receiver(post_delete, sender=models.Discover)
+@receiver(post_save, sender=models.OrgCategory)
+@receiver(post_delete, sender=models.OrgCategory)
+def inline_changed(sender, instance, raw=False, **kwargs):
+	# DiscoverInline and CategoryInline rows; deleting an item or a category cascades through here too
+	if not raw:
+		invalidate([instance.organization_id])
+
+
+@receiver(post_save, sender=models.Organization)
+def organization_saved(sender, instance, raw=False, **kwargs):
+	if not raw:
+		invalidate([instance.pk])
+
+
+# model: the organizations whose snapshot shows an instance of it
+SHOWN_BY = {
+	models.Item: lambda pk: _discovering([pk]),
+	# Places and Groups are saved as their own models
+	models.Place: lambda pk: _discovering([pk]),
+	models.Group: lambda pk: _discovering([pk]),
+	models.Category: lambda pk: _showing([pk]),
+	models.Tag: lambda pk: _tagged([pk]),
+	models.Tip: lambda pk: _tipping([pk]),
+}
+
+# model: the organizations to rebuild once an instance of it is deleted, worked out while its m2m rows are still there,
+# since they go without an m2m_changed signal. Deleting a Place or Group deletes its Item row too, so Item covers them.
+DELETED_FROM = {
+	# the groups it's leaving get a new item count; its own Discover rows cascade through inline_changed
+	models.Item: lambda pk: _discovering(models.Group.items.through.objects.filter(item=pk).values('group_id')),
+	models.Tag: lambda pk: _tagged([pk]),
+	models.Tip: lambda pk: _tipping([pk]),
+}
+
+
+def saved(sender, instance, raw=False, **kwargs):
+	if not raw:
+		invalidate(SHOWN_BY[sender](instance.pk))
+
+
+def deleting(sender, instance, **kwargs):
+	instance._snapshot_organizations = DELETED_FROM[sender](instance.pk)
+
+
+def deleted(sender, instance, **kwargs):
+	invalidate(getattr(instance, '_snapshot_organizations', []))
+
+
+for model in SHOWN_BY:
+	post_save.connect(saved, sender=model, dispatch_uid='snapshots_saved_%s' % model._meta.model_name)
+for model in DELETED_FROM:
+	pre_delete.connect(deleting, sender=model, dispatch_uid='snapshots_deleting_%s' % model._meta.model_name)
+	post_delete.connect(deleted, sender=model, dispatch_uid='snapshots_deleted_%s' % model._meta.model_name)
@@ -0,0 +1,97 @@
+import time
+
+from django.core.cache import cache
+from django.db.models.signals import m2m_changed, post_delete
+from django.dispatch import receiver
+
+from . import models
+
+
+# Each item's next items are cached on their own key, so marking an item done reads one small value. The keys carry a
+# version that's bumped whenever Item.next changes, which drops them all at once without knowing which items were touched.
+VERSION_KEY = 'unlocks:version'
+
+
+def _version():
+	version = cache.get(VERSION_KEY)
+	if version is None:
+		# start from the clock, so an evicted version can't come back and match keys left over from before
+		cache.add(VERSION_KEY, int(time.time() * 1000), None)
+		version = cache.get(VERSION_KEY)
+	return version
+
+
+def _key(version, item_id):
+	return 'unlocks:next:%s:%s' % (version, item_id)
+
+
+def invalidate():
+	try:
+		cache.incr(VERSION_KEY)
+	except ValueError:
+		cache.set(VERSION_KEY, int(time.time() * 1000), None)
+
+
+def next_items_many(item_ids):
+	# {item_id: items that get added to the user's list when it's completed}, one cache read, and one query for whatever missed
+	item_ids = set(item_ids)
+	if not item_ids:
+		return {}
+	version = _version()
+	keys = dict((_key(version, item_id), item_id) for item_id in item_ids)
+	found = dict((keys[key], next_ids) for key, next_ids in cache.get_many(keys.keys()).items())
+	missing = item_ids - set(found)
+	if missing:
+		loaded = dict((item_id, set()) for item_id in missing)
+		for from_id, to_id in models.Item.next.through.objects.filter(from_item_id__in=missing).values_list('from_item_id', 'to_item_id'):
+			loaded[from_id].add(to_id)
+		loaded = dict((item_id, frozenset(next_ids)) for item_id, next_ids in loaded.items())
+		cache.set_many(dict((_key(version, item_id), next_ids) for item_id, next_ids in loaded.items()), None)
+		found.update(loaded)
+	return found
+
+
+def next_items(item_id):
+	# items that get added to the user's list when this one is completed
+	return next_items_many([item_id])[item_id]
+
+
+def creates_cycle(item_id, next_ids):
+	# Would giving item_id these next items make a chain lead back to it? Only the admin asks, so it reads the whole
+	# Item.next graph from the database in one query rather than keeping it in the cache.
+	adjacency = {}
+	for from_id, to_id in models.Item.next.through.objects.values_list('from_item_id', 'to_item_id'):
+		adjacency.setdefault(from_id, set()).add(to_id)
+	seen = set()
+	stack = list(next_ids)
+	while stack:
+		n = stack.pop()
+		if n == item_id:
+			return True
+		if n not in seen:
+			seen.add(n)
+			stack.extend(adjacency.get(n, ()))
+	return False
+
+
+def unlock(profile, item_id):
+	# add the items unlocked by completing item_id to the profile's list: one set difference against what's already there, one bulk insert
+	next_ids = next_items(item_id)
+	if not next_ids:
+		return []
+	existing = set(models.Todo.objects.filter(profile=profile, item_id__in=next_ids).values_list('item_id', flat=True))
+	unlocked = [models.Todo(profile=profile, item_id=next_id, order=1, done=False) for next_id in next_ids if next_id not in existing]
+	models.Todo.objects.bulk_create(unlocked)
+	return [todo.item_id for todo in unlocked]
+
+
+@receiver(m2m_changed, sender=models.Item.next.through)
+def next_changed(sender, action, **kwargs):
+	if action in ('post_add', 'post_remove', 'post_clear'):
+		invalidate()
+
+
+@receiver(post_delete, sender=models.Item)
+def item_deleted(sender, instance, **kwargs):
+	# deleting an item cascades away its next rows without an m2m_changed signal
+	invalidate()
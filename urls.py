@@ -7,6 +7,7 @@ from rest_framework_jwt.views import refresh_jwt_token, verify_jwt_token
 from . import views
 from . import models
 from . import api
+from . import metrics
 
 
 # Routers provide a way of automatically determining the URL conf.
@@ -26,11 +27,15 @@ router.register(r'group', api.GroupViewSet)
 urlpatterns = [
 	path('admin/', admin.site.urls),
 	path('', views.test, name='test'),
+	path('metrics', metrics.metrics_view, name='metrics'),
+	# ahead of the router, which would take 'clusters' for a place id
+	url(r'^api/place/clusters/', api.PlaceClusters, name='placeclusters'),
 	url(r'^api/', include(router.urls)),
 	
 	url(r'^api/emailcheck/', api.emailCheck, name='emailcheck'),
 	url(r'^api/passwordcheck/', api.passwordCheck, name='passwordcheck'),
 	url(r'^api/onboarding/', api.onboarding, name='onboarding'),
+	url(r'^api/bulkonboarding/', api.bulkOnboarding, name='bulkonboarding'),
 	url(r'^api/addbookmark/', api.AddBookmark, name='addbookmark'),
 	url(r'^api/removebookmark/', api.RemoveBookmark, name='removebookmark'),
 	url(r'^api/adddone/', api.AddDone, name='adddone'),
@@ -40,6 +45,8 @@ urlpatterns = [
 	url(r'^api/addrating/', api.AddRating, name='addrating'),
 	url(r'^api/addtodo/', api.AddTodo, name='addtodo'),
 	url(r'^api/location/', api.Location, name='location'),
+	url(r'^api/batch/', api.Batch, name='batch'),
+	url(r'^api/search/', api.Search, name='search'),
 
 	url(r'^api-auth/', include('rest_framework.urls', namespace='rest_framework')),
 	url(r'^rest-auth/', include('rest_auth.urls')),
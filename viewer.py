@@ -0,0 +1,53 @@
+from . import models
+
+
+class ViewerState(object):
+	# Everything the card serializers need to know about the requesting profile: which items are on their list,
+	# which of those are done, what they've bookmarked and how they've rated places.
+	# It's loaded once per request with a handful of set-based queries, so get_done / get_todo / get_bookmarked / get_yourrating
+	# are answered from memory instead of firing a query per row.
+
+	def __init__(self, profile=None):
+		self.profile = profile
+		self.location = profile.location if profile is not None else None
+		self.todos = {}
+		self.bookmarks = set()
+		self.ratings = {}
+		if profile is not None:
+			self.load()
+
+	def load(self):
+		# Todo is ordered by 'order', so the first row per item wins, which matches the old .first().done lookups
+		for item_id, done in models.Todo.objects.filter(profile=self.profile).values_list('item_id', 'done'):
+			self.todos.setdefault(item_id, done)
+		self.bookmarks = set(models.Bookmark.objects.filter(profile=self.profile).values_list('item_id', flat=True))
+		self.ratings = dict(models.Rating.objects.filter(profile=self.profile).values_list('place_id', 'rating'))
+
+	def todo(self, item_id):
+		# true if this item is in the user's todo list
+		return item_id in self.todos
+
+	def done(self, item_id):
+		# true if this item is marked as done by the user, None if it's not on their list
+		return self.todos.get(item_id)
+
+	def bookmarked(self, item_id):
+		return item_id in self.bookmarks
+
+	def rating(self, place_id):
+		return self.ratings.get(place_id)
+
+
+def for_request(request):
+	# memoize the viewer state on the request, so every serializer in the response shares one load
+	if request is None:
+		return ViewerState()
+	state = getattr(request, '_viewer_state', None)
+	if state is None:
+		try:
+			profile = request.user.profile
+		except:
+			profile = None
+		state = ViewerState(profile)
+		request._viewer_state = state
+	return state